@@ -31,13 +31,27 @@ import os
 import os.path
 import logging
 import shutil
+import copy
 from optparse import OptionParser
 import math
 from PIL import Image
-import pickle
 import mmap
 import operator
 import struct
+import hashlib
+import zlib
+import time
+import threading
+import Queue
+import sqlite3
+import json
+import zipfile
+from cStringIO import StringIO
+
+try:
+    import numpy
+except ImportError:
+    numpy=None
 
 try:
     from osgeo import gdal
@@ -91,11 +105,189 @@ def sasplanet_hlg2ogr(fname):
 
 #############################
 
+def tile_quadkey(tile):
+    'sort key for the depth-first quadtree order of the tiles of a zoom level'
+#############################
+    z,x,y=tile
+    key=0
+    for i in range(max(z,x.bit_length(),y.bit_length())): # x may span several zoom 0 tiles
+        key|=((x>>i)&1)<<(2*i) | ((y>>i)&1)<<(2*i+1)
+    return key
+
+#############################
+
+def bands2tile(bands,tile_sz,transparency=None,opacity=None):
+    'make a tile image out of raw band buffers, estimate its opacity unless known already'
+#############################
+    if len(bands) == 1:
+        if opacity is None:
+            opacity=1
+            if transparency is not None:
+                if chr(transparency) in bands[0]:
+                    colorset=set(bands[0])
+                    if len(colorset) == 1:  # fully transparent
+                        opacity=0
+                    else:                   # semi-transparent
+                        opacity=-1
+        if opacity == 0:
+            return None,0
+        img=Image.frombuffer('L',tile_sz,bands[0],'raw','L',0,1)
+    else:
+        if opacity is None:
+            aplpha=bands[-1]
+            if min(aplpha) == '\xFF':       # fully opaque
+                opacity=1
+            elif max(aplpha) == '\x00':     # fully transparent
+                opacity=0
+            else:                           # semi-transparent
+                opacity=-1
+        if opacity == 0:
+            return None,0
+        if opacity == 1:
+            bands=bands[:-1]
+            mode='RGB' if len(bands) > 1 else 'L'
+        else:
+            mode='RGBA' if len(bands) > 2 else 'LA'
+        img=Image.merge(mode,[Image.frombuffer('L',tile_sz,b,'raw','L',0,1) for b in bands])
+    return img,opacity
+
+#############################
+
+def pixels2tile(data,tile_sz,samples_pp,transparency=None,opacity=None):
+    'make a tile image out of a pixel-interleaved buffer, semi-transparent RGBA tiles are mapped, not copied'
+#############################
+    if samples_pp == 1:
+        return bands2tile([data],tile_sz,transparency,opacity)
+    if opacity is None:
+        if numpy is not None:
+            alpha=numpy.frombuffer(data,numpy.uint8)[samples_pp-1::samples_pp]
+            lo,hi=alpha.min(),alpha.max()
+        else:
+            alpha=str(data)[samples_pp-1::samples_pp]
+            lo,hi=ord(min(alpha)),ord(max(alpha))
+        if lo == 255:       # fully opaque
+            opacity=1
+        elif hi == 0:       # fully transparent
+            opacity=0
+        else:               # semi-transparent
+            opacity=-1
+    if opacity == 0:
+        return None,0
+    mode='RGBA' if samples_pp == 4 else 'LA'
+    img=Image.frombuffer(mode,tile_sz,data,'raw',mode,0,1)
+    if opacity == 1:
+        img=img.convert(mode[:-1])
+    return img,opacity
+
+#############################
+
+def box_sum(arr,dz,dtype):
+    'sums over dz x dz pixel blocks'
+#############################
+    res=arr[0::dz,0::dz].astype(dtype)
+    for dy in range(dz):
+        for dx in range(dz):
+            if dx or dy:
+                res+=arr[dy::dz,dx::dz]
+    return res
+
+#############################
+
+def reduce_tiles(children,dz,tile_sz,mode,resampling,transparency=None):
+    'downsample (image,offset,opacity) child tiles into a parent tile, each child in one vectorized pass'
+#############################
+    tsx,tsy=tile_sz
+    bands=len(Image.new(mode,(1,1)).getbands())
+    alpha='A' in mode
+    n=dz*dz
+    out=numpy.zeros((tsy,tsx,bands),numpy.uint8)
+    if transparency is not None:
+        out[...]=transparency
+    for img,(ox,oy),opacity in children: # offsets are in parent tile pixels
+        if img.mode != mode:
+            img=img.convert(mode)
+        try:
+            data=img.tobytes()
+        except AttributeError: # old PIL
+            data=img.tostring()
+        src=numpy.frombuffer(data,numpy.uint8).reshape(tsy,tsx,bands)
+        dst=out[oy:oy+tsy//dz,ox:ox+tsx//dz]
+
+        if resampling == Image.NEAREST or mode == 'P':
+            # exact decimation, same pixel phase as PIL's nearest resize
+            dst[...]=src[dz//2::dz,dz//2::dz]
+            if alpha and opacity != 1: # blended over transparent black, as by PIL's masked paste
+                blend=dst.astype(numpy.uint32)*dst[...,-1:]+128
+                dst[...]=(blend+(blend>>8))>>8
+        elif not alpha or opacity == 1:
+            # box filter, 32 bits hold sums for blocks of any zoom gap
+            dst[...]=(box_sum(src,dz,numpy.uint32)+n//2)//n
+        else:
+            # box filter, colors are weighted by alpha
+            a=src[...,-1:]
+            alpha_sum=box_sum(a,dz,numpy.uint32)
+            color_sum=box_sum(numpy.multiply(src[...,:-1],a,dtype=numpy.uint16),dz,numpy.uint32)
+            dst[...,:-1]=(color_sum+alpha_sum//2)//numpy.maximum(alpha_sum,1)
+            dst[...,-1:]=(alpha_sum+n//2)//n
+
+    try:
+        return Image.frombytes(mode,tile_sz,out.tostring())
+    except AttributeError: # old PIL
+        return Image.fromstring(mode,tile_sz,out.tostring())
+
+#############################
+
+class ThinPlateSpline(object):
+    '''Thin plate spline through GCPs, the same interpolant as of the GDAL TPS transformer (needs numpy)'''
+#############################
+
+    chunk=16384 # points evaluated at once
+
+    def __init__(self,src_pts,dst_pts):
+        pts=numpy.array(src_pts,numpy.float64)
+        # normalized for a better conditioned system, the spline is the same
+        self.center=pts.mean(axis=0)
+        self.scale=max(numpy.abs(pts-self.center).max(),1.0)
+        self.pts=(pts-self.center)/self.scale
+
+        n=len(pts)
+        a=numpy.zeros((n+3,n+3))
+        a[:n,:n]=self.kernel(self.pts)
+        a[:n,n]=a[n,:n]=1
+        a[:n,n+1:]=self.pts
+        a[n+1:,:n]=self.pts.T
+        b=numpy.zeros((n+3,2))
+        b[:n]=numpy.array(dst_pts,numpy.float64)
+        try:
+            self.coef=numpy.linalg.solve(a,b)
+        except numpy.linalg.LinAlgError: # duplicate points
+            self.coef=numpy.linalg.lstsq(a,b,rcond=-1)[0]
+
+    def kernel(self,pts):
+        r2=((pts[:,numpy.newaxis,:]-self.pts[numpy.newaxis,:,:])**2).sum(axis=-1)
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            k=r2*numpy.log(r2)
+        k[r2 == 0]=0
+        return k
+
+    def __call__(self,pts):
+        'map an (n,2) array of points'
+        n=len(self.pts)
+        out=numpy.empty((len(pts),2))
+        for i in range(0,len(pts),self.chunk):
+            p=(pts[i:i+self.chunk]-self.center)/self.scale
+            out[i:i+self.chunk]=self.kernel(p).dot(self.coef[:n])+self.coef[n]+p.dot(self.coef[n+1:])
+        return out
+
+# ThinPlateSpline
+
+#############################
+
 class TiledTiff(object):
     '''Tile feeder for a base zoom level'''
 #############################
 
-    def __init__(self,img_fname,tile_first,tile_last,transparency=None):
+    def __init__(self,img_fname,tile_first,tile_last,transparency=None,classify=True):
         self.fname=img_fname
         self.tile_first=tile_first
         self.tile_last=tile_last
@@ -106,7 +298,10 @@ class TiledTiff(object):
         self.read_hdr() # in child class
         self.IFD0,next_IFD=self.read_IFD(self.IFD0_ofs)
 
-        assert self.tag_data('PlanarConfiguration')[0] == 2
+        try:
+            self.interleaved=self.tag_data('PlanarConfiguration')[0] == 1 # pixels rather than bands
+        except Exception:
+            self.interleaved=True # the default one, a single band anyway
         self.size=self.tag_data('ImageWidth')[0],self.tag_data('ImageLength')[0]
         self.tile_sz=self.tag_data('TileWidth')[0],self.tag_data('TileLength')[0]
         self.tile_range=map(lambda sz,tsz: (sz-1)//tsz+1,self.size,self.tile_sz)
@@ -115,6 +310,16 @@ class TiledTiff(object):
         self.tile_ofs=self.tag_data('TileOffsets')
         self.tile_lengths=self.tag_data('TileByteCounts')
         self.samples_pp=self.tag_data('SamplesPerPixel')[0]
+        try:
+            self.compression=self.tag_data('Compression')[0]
+        except Exception:
+            self.compression=1
+        assert self.compression in self.decoders, 'Unsupported base image compression: %d' % self.compression
+
+        self.opacity_map=None
+        if classify:
+            with stats.stage('classify',self.ntiles):
+                self.opacity_map=self.classify_tiles()
 
     def __del__(self):
         self.mmap.close()
@@ -129,33 +334,175 @@ class TiledTiff(object):
         d_x,d_y=self.tile_first
         idx=tile_x-d_x+(tile_y-d_y)*self.size[0]//tile_sz[0]
         assert idx >= 0 and idx < ntiles, 'tile: %s range: %s' % ((tile_x,tile_y),self.tile_range)
+
+        opacity=None
+        if self.opacity_map is not None:
+            opacity=int(self.opacity_map[idx])
+            if opacity == 0: # fully transparent, don't touch the tile data
+                return None,0
         
-        bands=[ src[ofs[idx+i*ntiles] : ofs[idx+i*ntiles] + lns[idx+i*ntiles]] 
-                for i in range(self.samples_pp)]
-        if self.samples_pp == 1:
-            opacity=1
-            mode='L'
-            if self.transparency is not None:
-                if chr(self.transparency) in bands[0]:
-                    colorset=set(bands[0])
-                    if len(colorset) == 1:  # fully transparent
-                        return None,0
-                    else:                   # semi-transparent
-                        opacity=-1
-            img=Image.frombuffer('L',tile_sz,bands[0],'raw','L',0,1)
+        # buffers over the mmap: uncompressed tile data goes to PIL without a copy
+        chunks=[buffer(src,ofs[idx+i*ntiles],lns[idx+i*ntiles])
+                for i in range(1 if self.interleaved else self.samples_pp)]
+        if self.compression != 1:
+            decode=self.decoders[self.compression]
+            chunks=[decode(self,c) for c in chunks]
+        if self.interleaved:
+            return pixels2tile(chunks[0],tile_sz,self.samples_pp,self.transparency,opacity)
+        return bands2tile(chunks,tile_sz,self.transparency,opacity)
+
+    prefetch_limit=64*1024*1024 # bytes asked to be read ahead at once
+
+    def prefetch(self,tiles):
+        'ask for the data of the tiles to be paged in ahead, adjacent chunks are merged into runs'
+        d_x,d_y=self.tile_first
+        ntiles=self.ntiles
+        planes=len(self.tile_ofs)//ntiles
+        chunks=[]
+        for tile_x,tile_y in tiles:
+            ofs_x,ofs_y=tile_x-d_x,tile_y-d_y
+            if not (0 <= ofs_x < self.tile_range[0] and 0 <= ofs_y < self.tile_range[1]):
+                continue
+            idx=ofs_x+ofs_y*self.tile_range[0]
+            if self.opacity_map is not None and self.opacity_map[idx] == 0:
+                continue # never read
+            for i in range(idx,planes*ntiles,ntiles):
+                if self.tile_lengths[i]:
+                    chunks.append((self.tile_ofs[i],self.tile_ofs[i]+self.tile_lengths[i]))
+        chunks.sort()
+        runs=[]
+        for start,end in chunks:
+            if runs and start <= runs[-1][1]+mmap.PAGESIZE:
+                runs[-1][1]=max(runs[-1][1],end)
+            else:
+                runs.append([start,end])
+        budget=self.prefetch_limit
+        for start,end in runs:
+            if budget <= 0:
+                break
+            length=min(end-start,budget)
+            madvise(self.mmap,start,length,MADV_WILLNEED)
+            budget-=length
+
+    def write_ordered(self,dst_fname,order):
+        'copy the raster into a BigTIFF with the tile data stored in the order given, the tags are kept'
+        ntiles=self.ntiles
+        planes=len(self.tile_ofs)//ntiles
+        nchunks=planes*ntiles
+        ofs_tag,len_tag=self.tag_map['TileOffsets'][0],self.tag_map['TileByteCounts'][0]
+
+        entries=[(ofs_tag,16,nchunks,None),(len_tag,16,nchunks,None)] # LONG8, filled in below
+        for tag_id,(tag,datatype,data_cnt,data_ofs) in self.IFD0.items():
+            if tag_id in (ofs_tag,len_tag) or datatype not in self.tag_types:
+                continue
+            nbytes=self.tag_types[datatype][0]*data_cnt
+            if nbytes <= self.ptr_len:
+                data=struct.pack(self.order+self.ptr_code,data_ofs)[0:nbytes]
+            else:
+                data=self.mmap[data_ofs:data_ofs+nbytes]
+            entries.append((tag_id,datatype,data_cnt,data))
+        entries.sort()
+
+        # header, IFD, long tag values, tile data
+        pos=16+8+20*len(entries)+8
+        values_ofs={}
+        for tag_id,datatype,data_cnt,data in entries:
+            nbytes=self.tag_types[datatype][0]*data_cnt
+            if nbytes > 8:
+                values_ofs[tag_id]=pos
+                pos+=(nbytes+7)//8*8
+        new_ofs=[0]*nchunks
+        new_lns=list(self.tile_lengths)
+        missing=set(range(ntiles)).difference(order)
+        order=list(order)+sorted(missing)
+        for idx in order:
+            for i in range(idx,nchunks,ntiles): # the bands of a tile go together
+                if new_lns[i]:
+                    new_ofs[i]=pos
+                    pos+=new_lns[i]
+        tile_arrays={
+            ofs_tag: struct.pack(self.order+'%dQ' % nchunks,*new_ofs),
+            len_tag: struct.pack(self.order+'%dQ' % nchunks,*new_lns),
+            }
+
+        with open(dst_fname,'wb') as f:
+            f.write(struct.pack(self.order+'2sHHHQ',self.signature[:2],43,8,0,16))
+            f.write(struct.pack(self.order+'Q',len(entries)))
+            for tag_id,datatype,data_cnt,data in entries:
+                f.write(struct.pack(self.order+'HHQ',tag_id,datatype,data_cnt))
+                if tag_id in values_ofs:
+                    f.write(struct.pack(self.order+'Q',values_ofs[tag_id]))
+                else:
+                    f.write(tile_arrays.get(tag_id,data).ljust(8,'\x00'))
+            f.write(struct.pack(self.order+'Q',0)) # no more IFDs
+            for tag_id,datatype,data_cnt,data in entries:
+                if tag_id in values_ofs:
+                    data=tile_arrays.get(tag_id,data)
+                    f.write(data.ljust((len(data)+7)//8*8,'\x00'))
+            for idx in order:
+                for i in range(idx,nchunks,ntiles):
+                    if new_lns[i]:
+                        f.write(buffer(self.mmap,self.tile_ofs[i],new_lns[i]))
+
+    def pil_decode(self,data,decoder):
+        mode='L'
+        if self.interleaved:
+            mode={1: 'L', 2: 'LA', 4: 'RGBA'}[self.samples_pp]
+        img=Image.frombuffer(mode,self.tile_sz,data,decoder,mode)
+        try:
+            return img.tobytes()
+        except AttributeError: # old PIL
+            return img.tostring()
+
+    decoders={
+        1:      None,                                               # none
+        8:      lambda self,data: zlib.decompress(data),            # Adobe deflate
+        32946:  lambda self,data: zlib.decompress(data),            # deflate
+        32773:  lambda self,data: self.pil_decode(data,'packbits'), # PackBits
+        }
+
+    chunk_tiles=64 # tiles per a classification pass
+
+    def classify_tiles(self):
+        'opacity of all the tiles (1, 0 or -1) by the tile index, straight from the mapped tile data'
+        if numpy is None or self.compression != 1: # compressed tiles are classified as they are decoded
+            return None
+        ntiles=self.ntiles
+        if self.samples_pp == 1 and self.transparency is None:
+            return numpy.ones(ntiles,numpy.int8)
+
+        tile_len=self.tile_sz[0]*self.tile_sz[1]
+        if self.interleaved:
+            band=0
+            tile_len*=self.samples_pp
         else:
-            aplpha=bands[-1]
-            if min(aplpha) == '\xFF':       # fully opaque
-                opacity=1
-                bands=bands[:-1]
-                mode='RGB' if self.samples_pp > 2 else 'L'
-            elif max(aplpha) == '\x00':     # fully transparent
-                return None,0
-            else:                           # semi-transparent
-                opacity=-1
-                mode='RGBA' if self.samples_pp > 2 else 'LA'
-            img=Image.merge(mode,[Image.frombuffer('L',tile_sz,b,'raw','L',0,1) for b in bands])
-        return img,opacity
+            band=self.samples_pp-1 # alpha or a paletted band
+        ofs=numpy.array(self.tile_ofs[band*ntiles:(band+1)*ntiles],numpy.int64)
+        lns=numpy.array(self.tile_lengths[band*ntiles:(band+1)*ntiles],numpy.int64)
+        if (lns != tile_len).any(): # sparse or truncated tiles
+            return None
+        data=numpy.frombuffer(self.mmap,numpy.uint8)
+
+        opacity_map=numpy.empty(ntiles,numpy.int8)
+        for start in range(0,ntiles,self.chunk_tiles):
+            chunk_ofs=ofs[start:start+self.chunk_tiles]
+            n=len(chunk_ofs)
+            if (numpy.diff(chunk_ofs) == tile_len).all(): # tiles are adjacent
+                tiles=data[chunk_ofs[0]:chunk_ofs[0]+n*tile_len].reshape(n,tile_len)
+            else:
+                tiles=numpy.vstack([data[o:o+tile_len] for o in chunk_ofs])
+            if self.interleaved: # alpha samples of the pixels
+                tiles=tiles[:,self.samples_pp-1::self.samples_pp]
+            if self.samples_pp == 1: # transparent color
+                is_transp=(tiles == self.transparency)
+                transparent=is_transp.all(axis=1)
+                opaque=~is_transp.any(axis=1)
+            else: # alpha band
+                transparent=(tiles.max(axis=1) == 0)
+                opaque=(tiles.min(axis=1) == 255)
+            opacity_map[start:start+n]=numpy.where(opaque,1,numpy.where(transparent,0,-1))
+        ld('classify_tiles',[(i,(opacity_map == i).sum()) for i in (1,0,-1)])
+        return opacity_map
 
     def unpack(self,fmt,start,len,src=None):
         if not src: 
@@ -195,7 +542,13 @@ class TiledTiff(object):
         3: (2,'H'), # SHORT
         4: (4,'I'), # LONG
         5: (8,'II'), # RATIONAL
-        # ...
+        6: (1,'b'), # SBYTE
+        7: (1,'B'), # UNDEFINED
+        8: (2,'h'), # SSHORT
+        9: (4,'i'), # SLONG
+        10:(8,'ii'), # SRATIONAL
+        11:(4,'f'), # FLOAT
+        12:(8,'d'), # DOUBLE
         16:(8,"Q"), # TIFF_LONG8
         17:(8,"q"), # TIFF_SLONG8
         18:(8,"Q"), # TIFF_IFD8        
@@ -205,7 +558,7 @@ class TiledTiff(object):
         tag_id=self.tag_map[name][0]
         try:
             tag,datatype,data_cnt,data_ofs=self.IFD0[tag_id]
-        except IndexError:
+        except (KeyError,IndexError):
             raise Exception('Tiff tag not found: %s' % name)        
         type_len,code=self.tag_types[datatype]
         nbytes=type_len*data_cnt       
@@ -273,7 +626,135 @@ img_type_map=(
 
 #############################
 
-def BaseImg(img_fname,tile_ul,tile_lr,transparency_color=None):
+class WarpedBase(object):
+    '''Tile feeder for a base zoom level, reads tiles directly from a warp VRT'''
+#############################
+
+    meta_cache=2 # metatiles kept, tiles are asked for in quadtree order
+
+    def __init__(self,vrt_fname,tile_first,tile_last,transparency=None,metatile=1):
+        self.fname=vrt_fname
+        self.tile_first=tile_first
+        self.tile_last=tile_last
+        self.transparency=transparency
+        self.metatile=metatile
+        self.pid=None
+
+        ds=self.dataset()
+        self.size=ds.RasterXSize,ds.RasterYSize
+        # VRT blocks are metatile-sized
+        self.tile_sz=[bsz//metatile for bsz in ds.GetRasterBand(1).GetBlockSize()]
+        self.tile_range=map(lambda sz,tsz: (sz-1)//tsz+1,self.size,self.tile_sz)
+        self.samples_pp=ds.RasterCount
+
+    def dataset(self):
+        # a GDAL dataset is not to be shared by processes: re-open it after a fork
+        if self.pid != os.getpid():
+            self.ds=gdal.Open(self.fname,GA_ReadOnly)
+            self.metatiles={}
+            self.meta_lru=[]
+            self.pid=os.getpid()
+        return self.ds
+
+    def tile(self,tile_x,tile_y):
+        tsx,tsy=self.tile_sz
+        d_x,d_y=self.tile_first
+        ofs_x,ofs_y=tile_x-d_x,tile_y-d_y
+        assert 0 <= ofs_x < self.tile_range[0] and 0 <= ofs_y < self.tile_range[1], \
+            'tile: %s range: %s' % ((tile_x,tile_y),self.tile_range)
+
+        if self.metatile == 1:
+            # one block is warped per a tile, the block cache is bounded by GDAL_CACHEMAX
+            with stats.stage('warp',tsx*tsy*self.samples_pp):
+                data=self.dataset().ReadRaster(ofs_x*tsx,ofs_y*tsy,tsx,tsy)
+            band_len=tsx*tsy
+            bands=[data[i*band_len:(i+1)*band_len] for i in range(self.samples_pp)]
+        else:
+            bands=self.metatile_bands(ofs_x,ofs_y)
+        return bands2tile(bands,self.tile_sz,self.transparency)
+
+    def prefetch(self,tiles):
+        pass # nothing to page in, the tiles are warped on demand
+
+    def metatile_bands(self,ofs_x,ofs_y):
+        'slice a tile out of a metatile warped at once'
+        n=self.metatile
+        tsx,tsy=self.tile_sz
+        meta=ofs_x//n,ofs_y//n
+        self.dataset()
+        if meta not in self.metatiles:
+            # the raster is aligned to metatiles, the ones at the right and the bottom may be cut
+            w=min(n,self.tile_range[0]-meta[0]*n)*tsx
+            h=min(n,self.tile_range[1]-meta[1]*n)*tsy
+            with stats.stage('warp',w*h*self.samples_pp):
+                data=self.ds.ReadRaster(meta[0]*n*tsx,meta[1]*n*tsy,w,h)
+            if numpy is not None:
+                data=numpy.frombuffer(data,numpy.uint8).reshape((self.samples_pp,h,w))
+            self.metatiles[meta]=(data,w,h)
+            self.meta_lru.append(meta)
+            if len(self.meta_lru) > self.meta_cache:
+                del self.metatiles[self.meta_lru.pop(0)]
+        data,w,h=self.metatiles[meta]
+
+        x0=(ofs_x-meta[0]*n)*tsx
+        y0=(ofs_y-meta[1]*n)*tsy
+        if numpy is not None:
+            return [b.tostring() for b in data[:,y0:y0+tsy,x0:x0+tsx]]
+        bands=[]
+        for i in range(self.samples_pp):
+            band_ofs=i*w*h+x0
+            bands.append(''.join([data[band_ofs+y*w:band_ofs+y*w+tsx] for y in range(y0,y0+tsy)]))
+        return bands
+
+# WarpedBase
+
+#############################
+
+class MosaicBase(object):
+    '''Tile feeder for a base zoom level stacked from several sources, the last one on top'''
+#############################
+
+    def __init__(self,layers):
+        self.layers=layers # tile feeders, each one covers its own tile range
+
+    def prefetch(self,tiles):
+        for layer in self.layers:
+            layer.prefetch(tiles)
+
+    def tile(self,tile_x,tile_y):
+        stack=[]
+        for layer in reversed(self.layers): # front to back
+            ofs_x,ofs_y=tile_x-layer.tile_first[0],tile_y-layer.tile_first[1]
+            if not (0 <= ofs_x < layer.tile_range[0] and 0 <= ofs_y < layer.tile_range[1]):
+                continue
+            img,opacity=layer.tile(tile_x,tile_y)
+            if opacity == 0:
+                continue
+            stack.append(img)
+            if opacity == 1: # the layers below are hidden
+                break
+        if not stack:
+            return None,0
+
+        # composite back to front
+        tile_img=stack.pop()
+        if stack or tile_img.mode not in ('RGB','RGBA'):
+            tile_img=tile_img.convert('RGBA')
+        while stack:
+            img=stack.pop().convert('RGBA')
+            tile_img=Image.composite(img,tile_img,img)
+        if tile_img.mode == 'RGB':
+            return tile_img,1
+        alpha_min,alpha_max=tile_img.split()[-1].getextrema()
+        if alpha_min == 255:
+            return tile_img.convert('RGB'),1
+        return tile_img,(0 if alpha_max == 0 else -1)
+
+# MosaicBase
+
+#############################
+
+def BaseImg(img_fname,tile_ul,tile_lr,transparency_color=None,classify=True):
 
 #############################
 
@@ -286,7 +767,7 @@ def BaseImg(img_fname,tile_ul,tile_lr,transparency_color=None):
     else:
         raise Exception('Invalid base image')
 
-    return img_cls(img_fname,tile_ul,tile_lr,transparency_color)
+    return img_cls(img_fname,tile_ul,tile_lr,transparency_color,classify)
     
 #############################
 
@@ -306,7 +787,7 @@ warp_vrt='''<VRTDataset rasterXSize="%(xsize)d" rasterYSize="%(ysize)d" subClass
   <BlockXSize>%(blxsize)d</BlockXSize>
   <BlockYSize>%(blysize)d</BlockYSize>
   <GDALWarpOptions>
-    <!-- <WarpMemoryLimit>6.71089e+07</WarpMemoryLimit> -->
+%(wo_WarpMemoryLimit)s
     <ResampleAlg>%(wo_ResampleAlg)s</ResampleAlg>
     <WorkingDataType>Byte</WorkingDataType>
     <SourceDataset relativeToVRT="0">%(wo_src_path)s</SourceDataset>
@@ -334,6 +815,8 @@ warp_vrt='''<VRTDataset rasterXSize="%(xsize)d" rasterYSize="%(ysize)d" subClass
 %(wo_DstAlphaBand)s%(wo_Cutline)s  </GDALWarpOptions>
 </VRTDataset>
 '''
+warp_memory_limit='    <WarpMemoryLimit>%d</WarpMemoryLimit>'
+warp_num_threads='<Option name="NUM_THREADS">%d</Option>'
 warp_band='  <VRTRasterBand dataType="Byte" band="%d" subClass="VRTWarpedRasterBand"%s>'
 warp_band_color='>\n    <ColorInterp>%s</ColorInterp>\n  </VRTRasterBand'
 warp_dst_alpha_band='    <DstAlphaBand>%d</DstAlphaBand>\n'
@@ -368,6 +851,22 @@ warp_src_tps_transformer='''            <SrcTPSTransformer>
                 </GCPList>
               </TPSTransformer>
             </SrcTPSTransformer>'''
+warp_src_geoloc_transformer='''            <SrcGeoLocTransformer>
+              <GeoLocTransformer>
+                <Reversed>0</Reversed>
+                <Metadata>
+                  <MDI key="X_DATASET">%(path)s</MDI>
+                  <MDI key="X_BAND">1</MDI>
+                  <MDI key="Y_DATASET">%(path)s</MDI>
+                  <MDI key="Y_BAND">2</MDI>
+                  <MDI key="PIXEL_OFFSET">0</MDI>
+                  <MDI key="LINE_OFFSET">0</MDI>
+                  <MDI key="PIXEL_STEP">%(step)d</MDI>
+                  <MDI key="LINE_STEP">%(step)d</MDI>
+                  <MDI key="GEOREFERENCING_CONVENTION">TOP_LEFT_CORNER</MDI>
+                </Metadata>
+              </GeoLocTransformer>
+            </SrcGeoLocTransformer>'''
 
 gcp_templ='    <GCP Id="%s" Pixel="%r" Line="%r" X="%r" Y="%r" Z="%r"/>'
 gcplst_templ='  <GCPList Projection="%s">\n%s\n  </GCPList>\n'
@@ -386,6 +885,16 @@ band_templ='''  <VRTRasterBand dataType="Byte" band="%(band)d">
   </VRTRasterBand>
 '''
 srs_templ='  <SRS>%s</SRS>\n'
+ovr_band_templ='''  <VRTRasterBand dataType="Byte" band="%(band)d">
+    <ColorInterp>%(color)s</ColorInterp>
+    <SimpleSource>
+      <SourceFilename relativeToVRT="0">%(src)s</SourceFilename>
+      <SourceBand>%(band)d</SourceBand>
+      <SrcRect xOff="0" yOff="0" xSize="%(xsize)d" ySize="%(ysize)d"/>
+      <DstRect xOff="0" yOff="0" xSize="%(ovr_xsize)d" ySize="%(ovr_ysize)d"/>
+    </SimpleSource>
+  </VRTRasterBand>
+'''
 vrt_templ='''<VRTDataset rasterXSize="%(xsize)d" rasterYSize="%(ysize)d">
 %(metadata)s%(srs)s%(geotr)s%(gcp_list)s%(band_list)s</VRTDataset>
 '''
@@ -411,11 +920,478 @@ def base_resampling_lst(): return base_resampling_map.keys()
 
 #############################
 
+class Journal(object):
+    '''Append-only log of completed steps, allows to restart an interrupted run'''
+#############################
+
+    def __init__(self,path):
+        self.path=path
+        self.entries=[]
+        try:
+            with open(path) as f:
+                for l in f:
+                    try:
+                        self.entries.append(json.loads(l))
+                    except ValueError: # an incomplete last line
+                        pass
+        except IOError:
+            pass
+
+    def add(self,*entry):
+        # a line is small enough to be appended atomically by any of the processes
+        with open(self.path,'a') as f:
+            f.write(json.dumps(entry)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries.append(list(entry))
+
+    def get_all(self,name):
+        return [e[1:] for e in self.entries if e[0] == name]
+
+    def get(self,name):
+        'the last entry of the kind'
+        found=self.get_all(name)
+        return found[-1] if found else None
+
+# Journal
+
+#############################
+
+class TileDedup(object):
+    '''Remembers written tiles by a hash of their pixels'''
+#############################
+
+    max_tiles=1<<16 # repeats are mostly uniform tiles, which show up early
+
+    def __init__(self):
+        self.tiles={}
+
+    def find(self,img):
+        'returns a pixel hash and a path to the first tile with such pixels (if any)'
+        h=hashlib.sha1('%s %s %s ' % (img.mode,img.size,img.info.get('transparency')))
+        if img.mode == 'P':
+            h.update(str(img.getpalette()))
+        try:
+            h.update(img.tobytes())
+        except AttributeError: # old PIL
+            h.update(img.tostring())
+        key=h.digest()
+        return key,self.tiles.get(key)
+
+    def add(self,key,path):
+        if len(self.tiles) < self.max_tiles:
+            self.tiles[key]=path
+
+# TileDedup
+
+#############################
+
+class TilePalette(object):
+    '''Pyramid-wide palette with an RGB lookup table for fast tile quantization'''
+#############################
+
+    colors=255
+    transparent=255     # palette index for transparent pixels
+    lut_bits=6          # per channel bits of the lookup table
+    sample_pixels=4096  # pixels per sample image
+
+    def __init__(self,palette):
+        self.palette=palette[:self.colors*3]
+        bits=self.lut_bits
+        pal=numpy.array(self.palette,numpy.float32).reshape(-1,3)
+
+        # nearest palette color for each lookup table cell center,
+        # |c-p|^2 is minimized by the smallest |p|^2-2c.p
+        levels=numpy.arange(1<<bits,dtype=numpy.float32)*(1<<(8-bits))+(1<<(7-bits))
+        grid=numpy.empty((1<<(bits*3),3),numpy.float32)
+        grid[:,0]=numpy.repeat(levels,1<<(bits*2))
+        grid[:,1]=numpy.tile(numpy.repeat(levels,1<<bits),1<<bits)
+        grid[:,2]=numpy.tile(levels,1<<(bits*2))
+        pal_norm=(pal*pal).sum(axis=1)
+        self.lut=numpy.empty(len(grid),numpy.uint8)
+        chunk=8192
+        for i in range(0,len(grid),chunk):
+            dist=pal_norm-2*numpy.dot(grid[i:i+chunk],pal.T)
+            self.lut[i:i+chunk]=dist.argmin(axis=1)
+
+    @classmethod
+    def from_sample(cls,images):
+        'median cut palette of the visible pixels of the sample images'
+        pixels=[]
+        for img in images:
+            rgba=numpy.frombuffer(img.convert('RGBA').tobytes(),numpy.uint8).reshape(-1,4)
+            rgba=rgba[rgba[:,3] >= 128]
+            step=max(1,len(rgba)//cls.sample_pixels)
+            pixels.append(rgba[::step,:3])
+        pixels=numpy.concatenate(pixels+[numpy.zeros((1,3),numpy.uint8)]) # never empty
+        sample=Image.frombytes('RGB',(len(pixels),1),pixels.tostring())
+        return cls(sample.convert('P',palette=Image.ADAPTIVE,colors=cls.colors).getpalette())
+
+    def quantize(self,img):
+        'map a tile through the lookup table'
+        if img.mode not in ('RGB','RGBA'):
+            img=img.convert('RGBA' if 'A' in img.mode else 'RGB')
+        bands=len(img.mode)
+        pix=numpy.frombuffer(img.tobytes(),numpy.uint8).reshape(-1,bands)
+        bits=self.lut_bits
+        shift=8-bits
+        cell=(pix[:,0]>>shift).astype(numpy.uint32)<<(bits*2)
+        cell|=(pix[:,1]>>shift).astype(numpy.uint32)<<bits
+        cell|=pix[:,2]>>shift
+        indices=self.lut[cell]
+        if bands == 4:
+            indices[pix[:,3] < 128]=self.transparent
+        p_img=Image.frombytes('P',img.size,indices.tostring())
+        p_img.putpalette(self.palette+[0,0,0])
+        if bands == 4:
+            p_img.info['transparency']=self.transparent
+        return p_img
+
+# TilePalette
+
+#############################
+
+class TileWriter(object):
+    '''Write-behind tile writer: runs encoding jobs in background threads'''
+#############################
+
+    jobs_per_thread=4 # queue limit: the tree walk waits for the writers beyond it
+
+    def __init__(self,nthreads=0):
+        self.nthreads=nthreads
+        self.pid=None
+
+    def start(self):
+        # threads don't survive a fork, so each process gets its own set
+        self.queue=Queue.Queue(self.nthreads*self.jobs_per_thread)
+        self.error=None
+        self.threads=[threading.Thread(target=self.run) for i in range(self.nthreads)]
+        for t in self.threads:
+            t.daemon=True
+            t.start()
+        self.pid=os.getpid()
+
+    def put(self,func,*args):
+        if not self.nthreads:
+            func(*args)
+            return
+        if self.pid != os.getpid():
+            self.start()
+        self.check()
+        self.queue.put((func,args)) # blocks while the queue is full
+
+    def run(self):
+        while True:
+            func,args=self.queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logging.exception('tile writer')
+                self.error=e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def join(self):
+        'wait for the queued tiles to be written'
+        if self.pid == os.getpid():
+            self.queue.join()
+            self.check()
+
+# TileWriter
+
+#############################
+
+class MBTiles(object):
+    '''MBTiles database output, tile images are keyed by their content and shared by duplicate tiles'''
+#############################
+
+    schema='''
+        create table if not exists metadata (name text, value text);
+        create unique index if not exists metadata_name on metadata (name);
+        create table if not exists images (tile_id text primary key, tile_data blob);
+        create table if not exists map (
+            zoom_level integer, tile_column integer, tile_row integer, tile_id text,
+            primary key (zoom_level, tile_column, tile_row));
+        create view if not exists tiles as
+            select map.zoom_level as zoom_level, map.tile_column as tile_column,
+                map.tile_row as tile_row, images.tile_data as tile_data
+            from map join images on images.tile_id = map.tile_id;
+        create table if not exists opacity (
+            zoom_level integer, tile_column integer, tile_row integer, opacity integer,
+            primary key (zoom_level, tile_column, tile_row));
+        '''
+
+    def __init__(self,path,zoom_tiles,commit_interval=1000):
+        self.path=path
+        self.zoom_tiles=zoom_tiles
+        self.commit_interval=commit_interval
+        self.pid=None
+        self.stale=[]
+        self.lock=threading.Lock() # writer threads share the connection
+
+        db=self.connect()
+        db.execute('pragma journal_mode=wal')
+        db.executescript(self.schema)
+
+    def connect(self):
+        # an SQLite connection must not cross a fork: each process opens its own
+        if self.pid != os.getpid():
+            if self.pid is not None:
+                self.stale.append(self.db) # parent's, leave it alone
+            self.db=sqlite3.connect(self.path,timeout=600,check_same_thread=False,isolation_level=None)
+            self.db.execute('pragma synchronous=normal')
+            self.queue=[]       # statements not written yet
+            self.queued_map={}  # tile ids of the queued map changes
+            self.pid=os.getpid()
+        return self.db
+
+    def tile_key(self,tile):
+        'MBTiles tile numbers: TMS rows'
+        z,x,y=tile
+        return z,x,self.zoom_tiles(z)[1]-1-y
+
+    def write_queue(self):
+        'write the queued statements in one short transaction, the lock is held'
+        # the processes share a single writer: no transaction is left open while tiles are rendered
+        if not self.queue:
+            return
+        db=self.db
+        db.execute('begin immediate')
+        try:
+            for sql,group in itertools.groupby(self.queue,key=operator.itemgetter(0)):
+                db.executemany(sql,[params for sql,params in group])
+            db.execute('commit')
+        except:
+            db.execute('rollback')
+            raise
+        self.queue=[]
+        self.queued_map={}
+
+    def enqueue(self,sql,params):
+        'the lock is held'
+        self.connect()
+        self.queue.append((sql,params))
+        if len(self.queue) >= self.commit_interval:
+            self.write_queue()
+
+    def execute(self,sql,params):
+        with self.lock:
+            self.enqueue(sql,params)
+
+    def query(self,sql,params):
+        'the first row of a query, the queued statements are written first'
+        with self.lock:
+            self.connect()
+            self.write_queue()
+            return self.db.execute(sql,params).fetchone()
+
+    def tile_id(self,key):
+        'image id of a tile (by its MBTiles key) or None, the lock is held'
+        if key in self.queued_map:
+            return self.queued_map[key]
+        row=self.connect().execute(
+            'select tile_id from map where zoom_level=? and tile_column=? and tile_row=?',key).fetchone()
+        return row[0] if row else None
+
+    def drop_image(self,tile_id):
+        'delete an image no tile refers to any more, the lock is held'
+        if tile_id is not None:
+            self.enqueue('delete from images where tile_id=? and tile_id not in (select tile_id from map)',
+                (tile_id,))
+
+    def map_tile(self,key,tile_id):
+        'point a tile to an image, the image it replaces is dropped unless shared; the lock is held'
+        old_id=self.tile_id(key)
+        self.enqueue('insert or replace into map (zoom_level,tile_column,tile_row,tile_id) values (?,?,?,?)',
+            key+(tile_id,))
+        self.queued_map[key]=tile_id
+        if old_id != tile_id:
+            self.drop_image(old_id)
+
+    def store_tile(self,tile,data):
+        # an image is never rewritten in place: the tiles linked to it stay as they are
+        tile_id=hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.enqueue('insert or ignore into images (tile_id,tile_data) values (?,?)',
+                (tile_id,buffer(data)))
+            self.map_tile(self.tile_key(tile),tile_id)
+
+    def read_tile(self,tile):
+        return str(self.query(
+            'select tile_data from tiles where zoom_level=? and tile_column=? and tile_row=?',
+            self.tile_key(tile))[0])
+
+    def read_opacity(self,tile):
+        row=self.query(
+            'select opacity from opacity where zoom_level=? and tile_column=? and tile_row=?',
+            self.tile_key(tile))
+        return row[0] if row else None
+
+    def remove_tile(self,tile):
+        key=self.tile_key(tile)
+        with self.lock:
+            tile_id=self.tile_id(key)
+            self.enqueue('delete from map where zoom_level=? and tile_column=? and tile_row=?',key)
+            self.queued_map[key]=None
+            self.enqueue('delete from opacity where zoom_level=? and tile_column=? and tile_row=?',key)
+            self.drop_image(tile_id)
+
+    def link_tile(self,first_tile,tile):
+        with self.lock:
+            self.map_tile(self.tile_key(tile),self.tile_id(self.tile_key(first_tile)))
+
+    def write(self,key,opacity):
+        self.execute('insert or replace into opacity (zoom_level,tile_column,tile_row,opacity) values (?,?,?,?)',
+            key+(opacity,))
+
+    def merge(self,path):
+        'copy the tiles and the opacities of another database, e.g. of a shard'
+        with self.lock:
+            db=self.connect()
+            self.write_queue()
+            db.execute('attach database ? as part',(path,))
+            db.execute('begin immediate')
+            for table in ('images','map','opacity'):
+                db.execute('insert or replace into %s select * from part.%s' % (table,table))
+            db.execute('commit')
+            db.execute('detach database part')
+
+    def set_metadata(self,**metadata):
+        for name in metadata:
+            self.execute('insert or replace into metadata (name,value) values (?,?)',(name,str(metadata[name])))
+
+    def flush(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.write_queue()
+
+    def close(self):
+        self.flush()
+        if self.pid == os.getpid():
+            self.db.close()
+            self.pid=None
+
+# MBTiles
+
+#############################
+
+def img2data(img):
+    'convert an image into a picklable tuple'
+#############################
+    if img is None:
+        return None
+    try:
+        data=img.tobytes()
+    except AttributeError: # old PIL
+        data=img.tostring()
+    palette=img.getpalette() if img.mode == 'P' else None
+    return img.mode,img.size,data,palette
+
+#############################
+
+def data2img(img_data):
+    'restore an image from the img2data() tuple'
+#############################
+    if img_data is None:
+        return None
+    mode,size,data,palette=img_data
+    try:
+        img=Image.frombytes(mode,size,data)
+    except AttributeError: # old PIL
+        img=Image.fromstring(mode,size,data)
+    if palette is not None:
+        img.putpalette(palette)
+    return img
+
+#############################
+
+class TileGrid(object):
+    '''Tile grid geometry: per zoom tables and bulk conversions of tiles to coordinates'''
+#############################
+
+    max_zoom=32
+    bulk_min=64 # NumPy pays off for longer lists only
+
+    def __init__(self,zoom0_res,zoom0_tiles,tile_sz,coord_offset):
+        self.tile_sz=tuple(tile_sz)
+        self.coord_offset=coord_offset # the pyramid's list: follows its SRS shift
+        zooms=range(self.max_zoom+1)
+        self.res=[[r/2**z for r in zoom0_res] for z in zooms]
+        self.ntiles=[[n*2**z for n in zoom0_tiles] for z in zooms]
+        self.corners={}
+        if numpy is not None:
+            self.res_array=numpy.array(self.res)
+            self.tile_sz_array=numpy.array(self.tile_sz,numpy.int64)
+
+    def coord2pix(self,zoom,coord):
+        'cartesian coordinates to pixel coordinates'
+        res=self.res[zoom]
+        off=self.coord_offset
+        return (int((coord[0]+off[0])/res[0]),int((off[1]-coord[1])/res[1]))
+
+    def pix2coord(self,zoom,pix_coord):
+        'pixel coordinates to cartesian coordinates'
+        res=self.res[zoom]
+        off=self.coord_offset
+        return [pix_coord[0]*res[0]-off[0],-(pix_coord[1]*res[1]-off[1])]
+
+    def tile2coord_box(self,tile):
+        'cartesian coordinates of tile corners'
+        z,x,y=tile
+        tsx,tsy=self.tile_sz
+        return [self.pix2coord(z,(x*tsx,y*tsy)),self.pix2coord(z,((x+1)*tsx,(y+1)*tsy))]
+
+    def tiles2coord_boxes(self,tiles):
+        'cartesian coordinates of corners for a list of tiles, (ul,lr) per tile'
+        if numpy is None or len(tiles) < self.bulk_min:
+            return [self.tile2coord_box(t) for t in tiles]
+        tiles=numpy.array(tiles,numpy.int64).reshape(-1,3)
+        res=self.res_array[tiles[:,0]]
+        off=self.coord_offset
+        boxes=numpy.empty((len(tiles),2,2))
+        ul_pix=tiles[:,1:]*self.tile_sz_array
+        for i,pix in enumerate((ul_pix,ul_pix+self.tile_sz_array)):
+            pix00_ofs=pix*res
+            boxes[:,i,0]=pix00_ofs[:,0]-off[0]
+            boxes[:,i,1]=-(pix00_ofs[:,1]-off[1])
+        return boxes
+
+    def corner_tiles(self,zoom,origin,extent):
+        'tiles at the corners of a cartesian box, cached'
+        key=(zoom,tuple(origin),tuple(extent),tuple(self.coord_offset))
+        try:
+            return self.corners[key]
+        except KeyError:
+            pass
+        tsx,tsy=self.tile_sz
+        p_ul=self.coord2pix(zoom,origin)
+        t_ul=[zoom,(p_ul[0]+1)//tsx,(p_ul[1]+1)//tsy]
+        p_lr=self.coord2pix(zoom,extent)
+        t_lr=[zoom,(p_lr[0]-1)//tsx,(p_lr[1]-1)//tsy]
+        ld('corner_tiles zoom',zoom,'zoom tiles',self.ntiles[zoom],
+            'p_ul',p_ul,'p_lr',p_lr,'t_ul',t_ul,'t_lr',t_lr)
+        self.corners[key]=t_ul,t_lr
+        return t_ul,t_lr
+
+# TileGrid
+
+#############################
+
 class Pyramid(object):
     '''Tile pyramid generator and utilities'''
 #############################
 
     tile_sz=(256,256)
+    palette_sample_tiles=64
+    assumed_memory=1024**3 # if the free memory is unknown
+    tps_max_step=128 # TPS grid steps, pixels
+    tps_min_step=4
+    tps_check_points=10000 # to check the geolocation round trip on
+    calibration_window=1024 # pixels
 
     #############################
 
@@ -425,6 +1401,18 @@ class Pyramid(object):
         gdal.UseExceptions()
 
         self.temp_files=[]
+        self.completed=False
+        self.reused_dest=False
+        self.update_tiles=None
+        self.tile_palette=None
+        self.subtree_zoom=None
+        self.mosaic=None # list of the sources stacked into one pyramid
+        self.layers=None
+        self.manifest=None
+        self.shard_roots=None # subtrees to render by a shard worker
+        self.shard_opacities=[]
+        self.tuning=None
+        self.anchors={} # zoom: tile feeder for the levels warped straight from the source
         self.palette=None
         self.transparency=None
         self.zoom_range=None
@@ -450,7 +1438,8 @@ class Pyramid(object):
     def __del__(self):
 
     #############################
-        if self.options and self.options.verbose < 2:
+        # an interrupted run keeps the temporary files for a restart
+        if self.options and self.options.verbose < 2 and self.completed:
             try:
                 for f in self.temp_files:
                     os.remove(f)
@@ -472,6 +1461,7 @@ class Pyramid(object):
         zoom0_tile_dim=[self.zoom0_res[0]*self.tile_sz[0],
                         self.zoom0_res[1]*self.tile_sz[1]]
         ld('zoom0_tiles',self.zoom0_tiles,'zoom0_tile_dim',zoom0_tile_dim,'coord_offset',self.coord_offset)
+        self.grid=TileGrid(self.zoom0_res,self.zoom0_tiles,self.tile_sz,self.coord_offset)
     
     #############################
 
@@ -485,20 +1475,42 @@ class Pyramid(object):
         self.tile_ext='.'+options.tile_format.lower()
         self.src_dir,src_f=os.path.split(self.src)
         self.base=os.path.splitext(src_f)[0]
+        if self.mosaic:
+            self.base=os.path.splitext(os.path.basename(options.mosaic))[0]
         self.base_resampling=base_resampling_map[options.base_resampling]
         self.resampling=resampling_map[options.overview_resampling]
 
         pf('\n%s -> %s '%(self.src,self.dest),end='')
 
+        journal_path=os.path.join(self.dest,'resume-journal')
+        signature=[self.mosaic or self.src,options.zoom,options.profile,
+                   options.tile_format,options.paletted,options.base_resampling,options.overview_resampling,
+                   options.anchors,options.mbtiles,options.kmz,options.dedup,options.cut,options.cutline,
+                   options.tps_grid,options.src_nodata,options.dst_nodata]
         if os.path.isdir(self.dest):
-            if options.noclobber and os.path.exists(os.path.join(self.dest,'merge-cache')):
+            if options.noclobber and (os.path.exists(os.path.join(self.dest,'merge-cache')) or
+                    os.path.exists(os.path.join(self.dest,self.base+'.mbtiles'))):
                 pf('*** Pyramid already exists: skipping',end='')
                 return False
+            elif options.update_region:
+                pf('*** Updating ',end='')
+                self.reused_dest=True
+            elif options.reduce_shards:
+                pf('*** Reducing shards ',end='')
+                self.reused_dest=True
+            elif options.resume and Journal(journal_path).get('start') == signature:
+                pf('*** Resuming ',end='')
+                self.reused_dest=True
             else:
                 shutil.rmtree(self.dest,ignore_errors=True)
 
         # connect to src dataset
-        self.get_src_ds()
+        with stats.stage('source open'):
+            self.get_src_ds()
+
+        self.journal=Journal(journal_path)
+        if self.journal.get('start') is None:
+            self.journal.add('start',*signature)
 
         # calculate zoom range
         self.calc_zoom(zoom_parm)
@@ -514,8 +1526,19 @@ class Pyramid(object):
             self.proj=shifted_srs
             self.proj2geog=MyTransformer(SRC_SRS=self.proj,DST_SRS=self.longlat)
 
+        if self.mosaic:
+            self.init_layers(shifted_srs)
+        else:
+            self.clip_to_source(shifted_srs)
+        return True
+
+    #############################
+
+    def clip_to_source(self,target_srs):
+        'clip the tileset area to the source raster'
+    #############################
         # get corners at the target SRS
-        target_ds=gdal.AutoCreateWarpedVRT(self.src_ds,None,proj4wkt(shifted_srs))
+        target_ds=gdal.AutoCreateWarpedVRT(self.src_ds,None,proj4wkt(target_srs))
         target_origin,target_extent=MyTransformer(target_ds).transform([(0,0),(target_ds.RasterXSize,target_ds.RasterYSize)])
 
         # clip to the max tileset area (set at the __init__)
@@ -527,9 +1550,33 @@ class Pyramid(object):
         self.origin[1]=min(self.origin[1],target_origin[1])
         self.extent[0]=min(self.extent[0],target_extent[0])
         self.extent[1]=max(self.extent[1],target_extent[1])
-        
-        return True
-        
+
+    #############################
+
+    def init_layers(self,target_srs):
+        'open the mosaic sources, they share the SRS and the shift of the first one and the zoom levels of the mosaic'
+    #############################
+        self.layers=[]
+        for src in self.mosaic:
+            layer=copy.copy(self)
+            layer.mosaic=layer.layers=None
+            layer.src=layer.src_path=src
+            layer.src_dir,src_f=os.path.split(src)
+            layer.base=os.path.splitext(src_f)[0]
+            layer.origin,layer.extent=list(self.origin),list(self.extent)
+            with stats.stage('source open'):
+                layer.get_src_ds()
+            layer.clip_to_source(target_srs)
+            if layer.origin[0] >= layer.extent[0] or layer.origin[1] <= layer.extent[1]:
+                logging.warning('%s is outside of the tileset area' % src)
+                continue
+            self.layers.append(layer)
+        assert self.layers, 'None of the sources is inside of the tileset area'
+
+        # the mosaic covers all of the layers
+        self.origin=[min(l.origin[0] for l in self.layers),max(l.origin[1] for l in self.layers)]
+        self.extent=[max(l.extent[0] for l in self.layers),min(l.extent[1] for l in self.layers)]
+
     #############################
 
     def get_src_ds(self):
@@ -545,7 +1592,8 @@ class Pyramid(object):
         self.src_ds=src_ds
 
         # source is successfully opened, then create destination dir
-        os.makedirs(self.dest)
+        if not os.path.isdir(self.dest):
+            os.makedirs(self.dest)
 
         src_geotr=src_ds.GetGeoTransform()
         src_proj=wkt2proj4(src_ds.GetProjection())
@@ -582,7 +1630,7 @@ class Pyramid(object):
                     transparency=len(pil_palette)/3-1
 
             ld('transparency',transparency)
-            if transparency is not None: # render in paletted mode
+            if transparency is not None and not self.options.mosaic: # render in paletted mode
                 self.transparency=transparency
                 self.palette=pil_palette
                 ld('self.palette',self.palette)
@@ -688,48 +1736,156 @@ class Pyramid(object):
 
     #############################
 
+    def auto_zoom(self):
+        'zoom levels matching the resolution and the size of the source raster'
+    #############################
+        # check raster parameters to find default zoom range
+        # modify target srs to allow charts crossing meridian 180
+        shifted_srs=self.shift_srs()
+
+        t_ds=gdal.AutoCreateWarpedVRT(self.src_ds,None,proj4wkt(shifted_srs))
+        geotr=t_ds.GetGeoTransform()
+        res=(geotr[1], -geotr[5])
+        max_zoom=max(self.res2zoom_xy(res))
+
+        # calculate min_zoom
+        ul_c=(geotr[0], geotr[3])
+        lr_c=gdal.ApplyGeoTransform(geotr,t_ds.RasterXSize,t_ds.RasterYSize)
+        wh=(lr_c[0]-ul_c[0],ul_c[1]-lr_c[1])
+        ld('res',res,'ul_c,lr_c,wh',ul_c,lr_c,wh)
+        min_zoom=min(self.res2zoom_xy([wh[i]/self.tile_sz[i]for i in (0,1)]))
+        return min_zoom,max_zoom
+
+    #############################
+
     def calc_zoom(self,zoom_parm):
         'determine and set a list of zoom levels to generate'
     #############################
-        res=None
         if not zoom_parm: # calculate "automatic" zoom levels
-            # check raster parameters to find default zoom range
-            # modify target srs to allow charts crossing meridian 180
             ld('automatic zoom levels')
-            shifted_srs=self.shift_srs()
-
-            t_ds=gdal.AutoCreateWarpedVRT(self.src_ds,None,proj4wkt(shifted_srs))
-            geotr=t_ds.GetGeoTransform()
-            res=(geotr[1], -geotr[5])
-            max_zoom=max(self.res2zoom_xy(res))
-
-            # calculate min_zoom
-            ul_c=(geotr[0], geotr[3])
-            lr_c=gdal.ApplyGeoTransform(geotr,t_ds.RasterXSize,t_ds.RasterYSize)
-            wh=(lr_c[0]-ul_c[0],ul_c[1]-lr_c[1])
-            ld('ul_c,lr_c,wh',ul_c,lr_c,wh)
-            min_zoom=min(self.res2zoom_xy([wh[i]/self.tile_sz[i]for i in (0,1)]))
+            if self.mosaic: # from the finest to the coarsest of all the sources
+                ranges=[]
+                for src in self.mosaic:
+                    layer=self
+                    if src != self.src:
+                        layer=copy.copy(self)
+                        layer.src=layer.src_path=src
+                        with stats.stage('source open'):
+                            layer.get_src_ds()
+                    ranges.append(layer.auto_zoom())
+                ld('mosaic zoom ranges',ranges)
+                min_zoom=min(r[0] for r in ranges)
+                max_zoom=max(r[1] for r in ranges)
+            else:
+                min_zoom,max_zoom=self.auto_zoom()
             zoom_parm='%d-%d'%(min_zoom,max_zoom)
 
         self.set_zoom_range(zoom_parm)
-        ld(('res',res,'zoom_range',self.zoom_range,'z0 (0,0)',self.coord2pix(0,(0,0))))
+        ld(('zoom_range',self.zoom_range,'z0 (0,0)',self.coord2pix(0,(0,0))))
 
     #############################
 
-    def make_base_raster(self):
+    def make_base_raster(self,max_metatile=None):
 
     #############################
+        if self.layers:
+            span=self.subtree_span() # the subtrees are the mosaic's ones
+            for layer in self.layers:
+                layer.make_base_raster(span)
+            del self.src_ds
+            self.base_img=MosaicBase([layer.base_img for layer in self.layers])
+            # anchor zooms the sources agree on
+            zooms=reduce(set.intersection,[set(layer.anchors) for layer in self.layers])
+            self.anchors=dict((zoom,MosaicBase([layer.anchors[zoom] for layer in self.layers]))
+                                for zoom in zooms)
+            return
 
         # adjust raster extents to tile boundaries
         tile_ul,tile_lr=self.corner_tiles(self.base_zoom)
-        ld('base_raster')
+        if self.options.autotune:
+            self.autotune(tile_ul,tile_lr)
+        metatile=self.options.metatile if self.streamed_base() else 1
+        if self.tuning:
+            metatile=self.tuning['metatile']
+        if max_metatile is None:
+            max_metatile=self.subtree_span()
+        if max_metatile and metatile > 1:
+            # a metatile shared by the subtrees would be warped by each of their workers
+            metatile=min(1<<(metatile.bit_length()-1),max_metatile)
+            if self.tuning:
+                self.tuning['metatile']=metatile
+        if metatile > 1: # align metatiles to the tile numbers, so they don't cross the subtrees
+            tile_ul=[tile_ul[0],tile_ul[1]-tile_ul[1]%metatile,tile_ul[2]-tile_ul[2]%metatile]
+        vrt_text=self.warp_vrt(self.base_zoom,tile_ul,tile_lr,metatile)
+
+        if self.tuning:
+            vrt_text=self.calibrate_warp(vrt_text)
+
+        temp_vrt=os.path.join(self.dest,self.base+'.tmp.vrt') # auxilary VRT file
+        self.temp_files.append(temp_vrt)
+        with open(temp_vrt,'w') as f:
+            f.write(vrt_text)
+        self.make_anchors()
+
+        if self.streamed_base():
+            # no intermediate raster: base tiles are warped on demand
+            del self.src_ds
+            self.base_img=WarpedBase(temp_vrt,tile_ul[1:],tile_lr[1:],self.transparency,metatile)
+            return
+
+        # warp base raster
+        tmp_ds = gdal.Open(vrt_text,GA_ReadOnly)
+        dst_drv = gdal.GetDriverByName('Gtiff')
+        base_tiff=os.path.join(self.dest,self.base+'.tmp_%i.tiff' % self.base_zoom) # img for the base zoom
+        self.temp_files.append(base_tiff)
+            
+        if [base_tiff,self.base_zoom] in self.journal.get_all('base') and os.path.exists(base_tiff):
+            ld('base raster is complete already',base_tiff)
+        else:
+            compression=self.base_compression(tmp_ds)
+            ld('base compression',compression)
+            tiff_options=[
+                'TILED=YES',
+                'INTERLEAVE=%s' % self.options.base_interleave.upper(),
+                'BLOCKXSIZE=%i' % self.tile_sz[0],
+                'BLOCKYSIZE=%i' % self.tile_sz[1],
+                ]
+            if compression != 'NONE':
+                tiff_options.append('COMPRESS=%s' % compression)
+                if compression == 'DEFLATE':
+                    tiff_options.append('ZLEVEL=1') # scratch file: speed matters, not size
+
+            pf('...',end='')
+            with stats.stage('warp',tmp_ds.RasterXSize*tmp_ds.RasterYSize*tmp_ds.RasterCount):
+                dst_ds = dst_drv.CreateCopy(base_tiff,tmp_ds,0,tiff_options)#, gdal.TermProgress)
+                del dst_ds
+            pf('.',end='')
+            if self.options.base_order == 'quadtree':
+                with stats.stage('reorder',tmp_ds.RasterXSize*tmp_ds.RasterYSize*tmp_ds.RasterCount):
+                    self.reorder_base(base_tiff,tile_ul)
+                pf('.',end='')
+            self.journal.add('base',base_tiff,self.base_zoom)
+        
+        # close datasets in a proper order
+        del tmp_ds
+        del self.src_ds
+
+        # create base_image raster
+        self.base_img=BaseImg(base_tiff,tile_ul[1:],tile_lr[1:],self.transparency)
+
+    #############################
+
+    def warp_vrt(self,zoom,tile_ul,tile_lr,metatile,src_ovr=None):
+        'warp VRT for the tiles of a zoom level, src_ovr is a downscaled source with its scale factors'
+    #############################
+        ld('warp_vrt',zoom,'src_ovr',src_ovr)
         ld('tile_ul',tile_ul,'tile_lr',tile_lr)
         ul_c=self.tile2coord_box(tile_ul)[0]
         lr_c=self.tile2coord_box(tile_lr)[1]
         ul_pix=self.tile_corners(tile_ul)[0]
         lr_pix=self.tile_corners(tile_lr)[1]
 
-        # base zoom level raster size
+        # zoom level raster size
         dst_xsize=lr_pix[0]-ul_pix[0] 
         dst_ysize=lr_pix[1]-ul_pix[1]        
 
@@ -737,14 +1893,18 @@ class Pyramid(object):
         ld('Lower Right',self.extent,lr_c,self.proj2geog.transform([self.extent,lr_c]))
         ld('coord_offset',self.coord_offset,'ul_c+c_off',map(operator.add,ul_c,self.coord_offset))
 
-        # create VRT for base image warp
-
         # generate warp transform
         src_geotr=self.src_ds.GetGeoTransform()
         src_proj=wkt2proj4(self.src_ds.GetProjection())
         gcp_proj=None
+        src_path=self.src_path
+        scale_x,scale_y=1,1
+        if src_ovr is not None: # source pixels are scaled down
+            src_path,scale_x,scale_y=src_ovr
 
         if src_geotr and src_geotr != (0.0, 1.0, 0.0, 0.0, 0.0, 1.0):
+            src_geotr=(src_geotr[0],src_geotr[1]*scale_x,src_geotr[2]*scale_y,
+                       src_geotr[3],src_geotr[4]*scale_x,src_geotr[5]*scale_y)
             ok,src_igeotr=gdal.InvGeoTransform(src_geotr)
             assert ok
             src_transform='%s\n%s' % (warp_src_geotr % src_geotr,warp_src_igeotr % src_igeotr)
@@ -752,7 +1912,7 @@ class Pyramid(object):
             gcps=self.src_ds.GetGCPs()
             assert gcps, 'Neither geotransform, nor gpcs are in the source file %s' % self.src
 
-            gcp_lst=[(g.Id,g.GCPPixel,g.GCPLine,g.GCPX,g.GCPY,g.GCPZ) for g in gcps]
+            gcp_lst=[(g.Id,g.GCPPixel/scale_x,g.GCPLine/scale_y,g.GCPX,g.GCPY,g.GCPZ) for g in gcps]
             ld('src_proj',self.src_ds.GetProjection())
             ld('gcp_proj',self.src_ds.GetGCPProjection())
             gcp_proj=wkt2proj4(self.src_ds.GetGCPProjection())
@@ -762,11 +1922,18 @@ class Pyramid(object):
 
             gcp_txt='\n'.join((gcp_templ % g for g in gcp_lst))
             #src_transform=warp_src_gcp_transformer % (0,gcp_txt)
-            src_transform=warp_src_tps_transformer % gcp_txt
+            src_transform=None
+            if self.options.tps_grid and src_ovr is None:
+                if numpy is None:
+                    logging.warning('--tps-grid needs numpy, using the TPS transformer')
+                else:
+                    src_transform=self.tps_geoloc(gcp_lst)
+            if src_transform is None:
+                src_transform=warp_src_tps_transformer % gcp_txt
 
-        res=self.zoom2res(self.base_zoom)
+        res=self.zoom2res(zoom)
         ul_ll,lr_ll=self.coords2longlat([ul_c,lr_c])
-        ld('base_zoom',self.base_zoom,'size',dst_xsize,dst_ysize,'-tr',res[0],res[1],'-te',ul_c[0],lr_c[1],lr_c[0],ul_c[1],'-t_srs',self.proj)
+        ld('zoom',zoom,'size',dst_xsize,dst_ysize,'-tr',res[0],res[1],'-te',ul_c[0],lr_c[1],lr_c[0],ul_c[1],'-t_srs',self.proj)
         dst_geotr=( ul_c[0], res[0],     0.0,
                     ul_c[1],    0.0, -res[1] )
         ok,dst_igeotr=gdal.InvGeoTransform(dst_geotr)
@@ -779,12 +1946,18 @@ class Pyramid(object):
             return '    <Option name="%s">%s</Option>' % (name,value)
 
         warp_options.append(w_option('INIT_DEST','NO_DATA'))
+        if self.tuning:
+            warp_options.append('    '+warp_num_threads % self.tuning['num_threads'])
 
         # generate cut line
         if self.options.cut:
             cut_wkt=self.get_cutline()
         else:
             cut_wkt=None
+        if cut_wkt and src_ovr is not None: # the cutline is in source pixels
+            number=r'(-?[\d.]+(?:[eE][-+]?\d+)?)'
+            cut_wkt=re.sub(number+' '+number,
+                lambda m: '%r %r' % (float(m.group(1))/scale_x,float(m.group(2))/scale_y),cut_wkt)
         if cut_wkt:
             warp_options.append(w_option('CUTLINE',cut_wkt))
             if self.options.blend_dist:
@@ -821,7 +1994,7 @@ class Pyramid(object):
         if src_bands < 4 and self.palette is None:
             vrt_bands.append(warp_band % (src_bands+1,warp_band_color % 'Alpha'))
 
-        block_sz=self.tile_sz
+        block_sz=[tsz*metatile for tsz in self.tile_sz] # a block is warped at once
 
         vrt_text=warp_vrt % {
             'xsize':            dst_xsize,
@@ -831,8 +2004,10 @@ class Pyramid(object):
             'band_list':        '\n'.join(vrt_bands),
             'blxsize':          block_sz[0],
             'blysize':          block_sz[1],
+            'wo_WarpMemoryLimit': warp_memory_limit % self.tuning['warp_memory'] if self.tuning else
+                                '    <!-- <WarpMemoryLimit>6.71089e+07</WarpMemoryLimit> -->',
             'wo_ResampleAlg':   self.base_resampling,
-            'wo_src_path':      self.src_path,
+            'wo_src_path':      src_path,
             'warp_options':     '\n'.join(warp_options),
             'wo_src_srs':       gcp_proj if gcp_proj else src_proj,
             'wo_dst_srs':       self.proj,
@@ -842,42 +2017,307 @@ class Pyramid(object):
             'wo_DstAlphaBand':  warp_dst_alpha_band % (src_bands+1) if src_bands < 4  and self.palette is None else '',
             'wo_Cutline':       (warp_cutline % cut_wkt) if cut_wkt else '',
             }
-
-        temp_vrt=os.path.join(self.dest,self.base+'.tmp.vrt') # auxilary VRT file
-        self.temp_files.append(temp_vrt)
-        with open(temp_vrt,'w') as f:
-            f.write(vrt_text)
-
-        # warp base raster
-        tmp_ds = gdal.Open(vrt_text,GA_ReadOnly)
-        dst_drv = gdal.GetDriverByName('Gtiff')
-        base_tiff=os.path.join(self.dest,self.base+'.tmp_%i.tiff' % self.base_zoom) # img for the base zoom
-        self.temp_files.append(base_tiff)
-            
-        pf('...',end='')
-        dst_ds = dst_drv.CreateCopy(base_tiff,tmp_ds,0,[
-			'TILED=YES',
-            'INTERLEAVE=BAND',
-            'BLOCKXSIZE=%i' % self.tile_sz[0],
-            'BLOCKYSIZE=%i' % self.tile_sz[1],
-            ])#, gdal.TermProgress)
-        pf('.',end='')
-        
-        # close datasets in a proper order
-        del dst_ds
-        del tmp_ds
-        del self.src_ds
-
-        # create base_image raster
-        self.base_img=BaseImg(base_tiff,tile_ul[1:],tile_lr[1:],self.transparency)
+        return vrt_text
 
     #############################
 
-    def get_cutline(self):
+    anchor_step=3       # zoom levels built out of the children between the anchors, at least
+    anchor_ovr_slack=2  # source pixels per target pixel (per axis) to be read at most
 
+    def plan_anchors(self):
+        'overview zooms to warp straight from the source: zoom -> source overview size to read from'
     #############################
+        if not self.options.anchors:
+            return {}
         src_ds=self.src_ds
-        src_proj=wkt2proj4(src_ds.GetProjection())
+        src_size=(src_ds.RasterXSize,src_ds.RasterYSize)
+        band=src_ds.GetRasterBand(1)
+        ovr_sizes=[src_size]+[(ovr.XSize,ovr.YSize) for ovr in
+                    (band.GetOverview(i) for i in range(band.GetOverviewCount())) if ovr is not None]
+
+        # source pixels per a base zoom pixel
+        ul,lr=MyTransformer(src_ds,DST_SRS=self.proj).transform([(0,0),src_size])
+        src_res=abs(lr[0]-ul[0])/src_size[0]
+        base_ratio=self.zoom2res(self.base_zoom)[0]/src_res
+
+        def best_ovr(zoom): # the smallest overview which is still fine enough
+            need=base_ratio*2**(self.base_zoom-zoom)
+            fine=[sz for sz in ovr_sizes if float(src_size[0])/sz[0] <= need] or [src_size]
+            ovr_size=min(fine)
+            return ovr_size,need/(float(src_size[0])/ovr_size[0])
+
+        plan={}
+        if self.options.anchors != 'auto':
+            for zoom in map(int,self.options.anchors.split(',')):
+                if zoom in self.zoom_range[1:]:
+                    plan[zoom]=best_ovr(zoom)[0]
+                else:
+                    logging.warning('anchor zoom %d is not an overview zoom of the pyramid' % zoom)
+        else:
+            last=0 # zoom_range index of the last level warped: the base
+            for i,zoom in enumerate(self.zoom_range):
+                if i-last < self.anchor_step:
+                    continue
+                ovr_size,excess=best_ovr(zoom)
+                if excess <= self.anchor_ovr_slack:
+                    plan[zoom]=ovr_size
+                    last=i
+        ld('plan_anchors',base_ratio,ovr_sizes,plan)
+        return plan
+
+    #############################
+
+    def make_anchors(self):
+        'warp VRTs for the anchor zooms, they read the source overviews through downscaled source VRTs'
+    #############################
+        self.anchors={}
+        src_ds=self.src_ds
+        src_size=(src_ds.RasterXSize,src_ds.RasterYSize)
+        for zoom,ovr_size in sorted(self.plan_anchors().items()):
+            src_ovr=None
+            if ovr_size != src_size:
+                ovr_vrt=os.path.join(self.dest,self.base+'.ovr_%dx%d.vrt' % ovr_size)
+                if ovr_vrt not in self.temp_files:
+                    self.temp_files.append(ovr_vrt)
+                    color_names=[gdal.GetColorInterpretationName(src_ds.GetRasterBand(i+1).GetColorInterpretation())
+                                    for i in range(src_ds.RasterCount)]
+                    color_names=[name if name != 'Palette' else 'Gray' for name in color_names] # the indices
+                    band_lst=''.join((ovr_band_templ % {
+                        'band':     i+1,
+                        'color':    color_names[i],
+                        'src':      self.src_path,
+                        'xsize':    src_size[0],
+                        'ysize':    src_size[1],
+                        'ovr_xsize':ovr_size[0],
+                        'ovr_ysize':ovr_size[1],
+                        } for i in range(src_ds.RasterCount)))
+                    with open(ovr_vrt,'w') as f:
+                        f.write(vrt_templ % {
+                            'xsize':    ovr_size[0],
+                            'ysize':    ovr_size[1],
+                            'metadata': '',
+                            'srs':      '',
+                            'geotr':    '',
+                            'gcp_list': '',
+                            'band_list':band_lst,
+                            })
+                src_ovr=(ovr_vrt,float(src_size[0])/ovr_size[0],float(src_size[1])/ovr_size[1])
+
+            tile_ul,tile_lr=self.corner_tiles(zoom)
+            anchor_vrt=os.path.join(self.dest,self.base+'.anchor_%i.vrt' % zoom)
+            self.temp_files.append(anchor_vrt)
+            with open(anchor_vrt,'w') as f:
+                f.write(self.warp_vrt(zoom,tile_ul,tile_lr,1,src_ovr))
+            self.anchors[zoom]=WarpedBase(anchor_vrt,tile_ul[1:],tile_lr[1:],self.transparency)
+        if self.anchors:
+            pf(' anchors %s' % ','.join(map(str,sorted(self.anchors))),end='')
+
+    #############################
+
+    def reorder_base(self,base_tiff,tile_ul):
+        'rewrite the base raster with the tiles in the order the subtrees are walked in'
+    #############################
+        img=BaseImg(base_tiff,tile_ul[1:],tile_ul[1:],classify=False) # the tiles are only copied
+        zoom_dim=self.zoom_tiles(self.base_zoom)
+        row_len=img.tile_range[0]
+        def quadkey(idx): # of the tile as it is in the pyramid
+            x,y=tile_ul[1]+idx % row_len,tile_ul[2]+idx // row_len
+            return tile_quadkey((self.base_zoom,x % zoom_dim[0],y))
+        order=sorted(range(img.ntiles),key=quadkey)
+
+        ordered_tiff=base_tiff+'.ordered'
+        self.temp_files.append(ordered_tiff)
+        img.write_ordered(ordered_tiff,order)
+        del img
+        os.remove(base_tiff)
+        os.rename(ordered_tiff,base_tiff)
+
+    #############################
+
+    def autotune(self,tile_ul,tile_lr):
+        'warp memory, threads, block cache and warp block size out of the rasters and the free memory'
+    #############################
+        src_ds=self.src_ds
+        src_block=src_ds.GetRasterBand(1).GetBlockSize()
+        src_bands=src_ds.RasterCount
+        src_bytes=src_ds.RasterXSize*src_ds.RasterYSize*src_bands
+        dst_size=[(lr-ul+1)*tsz for ul,lr,tsz in zip(tile_ul[1:],tile_lr[1:],self.tile_sz)]
+
+        # memory share of each of the processes warping at the same time
+        streamed=self.streamed_base()
+        ncpu=cpu_count()
+        nproc=ncpu if streamed and parallel_enabled() else 1 # otherwise the base raster is warped before forking
+        free=available_memory()
+        budget=(free or self.assumed_memory)//2//nproc
+
+        cache_max=max(min(budget//2,src_bytes,2**31-1),32*1024**2) # there is no use in caching beyond the source
+        warp_memory=max(min(budget//4,2**31-1),64*1024**2)
+        num_threads=max(1,ncpu//nproc)
+
+        # streamed base: warp blocks covering a source block at least, within the warp memory
+        metatile=self.options.metatile if streamed else 1
+        if streamed and metatile == 1:
+            scale=math.sqrt(float(src_ds.RasterXSize*src_ds.RasterYSize)/(dst_size[0]*dst_size[1]))
+            footprint=self.tile_sz[0]*scale # source pixels across a tile
+            while (metatile < 8 and metatile*footprint < max(src_block)
+                    and (metatile*2)**2*self.tile_sz[0]*self.tile_sz[1]*(src_bands+1)*2 <= warp_memory):
+                metatile*=2
+
+        gdal.SetCacheMax(int(cache_max))
+        self.tuning=dict(
+            free_memory=    free,
+            processes=      nproc,
+            src_block=      src_block,
+            cache_max=      cache_max,
+            warp_memory=    warp_memory,
+            num_threads=    num_threads,
+            metatile=       metatile,
+            )
+        ld('autotune',self.tuning)
+
+    #############################
+
+    def calibrate_warp(self,vrt_text):
+        'time a sample window warp with 1 and with the tuned number of threads, keep the faster'
+    #############################
+        tuned=self.tuning['num_threads']
+        option=warp_num_threads % tuned
+        times={}
+        for n in [None]+sorted(set([1,tuned])): # the first pass warms the block cache up
+            ds=gdal.Open(vrt_text.replace(option,warp_num_threads % (n or tuned)),GA_ReadOnly)
+            w=min(ds.RasterXSize,self.calibration_window)
+            h=min(ds.RasterYSize,self.calibration_window)
+            start=time.time()
+            ds.ReadRaster((ds.RasterXSize-w)//2,(ds.RasterYSize-h)//2,w,h)
+            if n is not None:
+                times[n]=time.time()-start
+            del ds
+        best=min(times,key=times.get)
+        self.tuning['num_threads']=best
+        self.tuning['calibration']=dict(
+            window=     [w,h],
+            seconds=    dict([(str(n),t) for n,t in times.items()]),
+            )
+        ld('calibration',self.tuning['calibration'])
+        return vrt_text.replace(option,warp_num_threads % best)
+
+    #############################
+
+    def streamed_base(self):
+        'base tiles are warped on demand, without an intermediate base raster'
+    #############################
+        return bool(self.options.stream_base or self.options.update_region or self.sharded())
+
+    #############################
+
+    def tps_geoloc(self,gcp_lst):
+        'evaluate the GCP thin plate spline on a grid, fine enough for the error bound, as a geolocation array'
+    #############################
+        if int(gdal.VersionInfo()) < 3050000: # GEOREFERENCING_CONVENTION is ignored before 3.5
+            logging.warning('--tps-grid needs GDAL 3.5 or later, using the TPS transformer')
+            return None
+
+        tps=ThinPlateSpline([g[1:3] for g in gcp_lst],[g[3:5] for g in gcp_lst])
+        xsize,ysize=self.src_ds.RasterXSize,self.src_ds.RasterYSize
+        max_error=self.options.tps_grid # source pixels
+
+        step=self.tps_max_step
+        while True:
+            nx=(xsize+step-1)//step+1
+            ny=(ysize+step-1)//step+1
+            gx,gy=numpy.meshgrid(numpy.arange(nx)*float(step),numpy.arange(ny)*float(step))
+            grid=tps(numpy.column_stack((gx.ravel(),gy.ravel()))).reshape((ny,nx,2))
+            if step <= self.tps_min_step:
+                break
+
+            # bilinear interpolation is the worst at the cell centers
+            centers=tps(numpy.column_stack((gx[:-1,:-1].ravel()+step/2.,gy[:-1,:-1].ravel()+step/2.)))
+            interp=(grid[:-1,:-1]+grid[:-1,1:]+grid[1:,:-1]+grid[1:,1:])/4
+            dev=interp.reshape((-1,2))-centers
+            dx=(grid[:-1,1:]-grid[:-1,:-1]).reshape((-1,2))
+            dy=(grid[1:,:-1]-grid[:-1,:-1]).reshape((-1,2))
+            pix_sz=(numpy.hypot(dx[:,0],dx[:,1])+numpy.hypot(dy[:,0],dy[:,1]))/(2*step)
+            with numpy.errstate(divide='ignore',invalid='ignore'):
+                error=numpy.nanmax(numpy.hypot(dev[:,0],dev[:,1])/pix_sz)
+            ld('tps grid step',step,'error',error)
+            if error <= max_error:
+                break
+            step//=2
+
+        geoloc=os.path.join(self.dest,self.base+'.geoloc.tiff')
+        self.temp_files.append(geoloc)
+        ds=gdal.GetDriverByName('GTiff').Create(geoloc,nx,ny,2,GDT_Float64)
+        for i in (0,1):
+            ds.GetRasterBand(i+1).WriteRaster(0,0,nx,ny,numpy.ascontiguousarray(grid[:,:,i]).tostring())
+        del ds
+
+        # the warp maps target pixels back through the inverse of the geolocation arrays, check the round trip
+        geoloc_md=dict(X_DATASET=geoloc,X_BAND='1',Y_DATASET=geoloc,Y_BAND='2',
+                       PIXEL_OFFSET='0',LINE_OFFSET='0',PIXEL_STEP=str(step),LINE_STEP=str(step),
+                       GEOREFERENCING_CONVENTION='TOP_LEFT_CORNER')
+        ref_ds=gdal.GetDriverByName('MEM').Create('',xsize,ysize,0)
+        ref_ds.SetMetadata(geoloc_md,'GEOLOCATION')
+        geoloc_tr=gdal.Transformer(ref_ds,None,['METHOD=GEOLOC_ARRAY'])
+        stride=max(1,int(math.sqrt((nx-1)*(ny-1)/self.tps_check_points)))
+        px,py=numpy.meshgrid((numpy.arange(0,nx-1,stride)+.5)*step,(numpy.arange(0,ny-1,stride)+.5)*step)
+        pixels=numpy.column_stack((px.ravel(),py.ravel()))
+        pixels=pixels[(pixels[:,0] < xsize) & (pixels[:,1] < ysize)]
+        back,ok=geoloc_tr.TransformPoints(1,tps(pixels).tolist())
+        del geoloc_tr,ref_ds
+        error=numpy.hypot(*(numpy.array(back)[:,:2]-pixels).T)
+        error[numpy.logical_not(numpy.array(ok,bool))]=numpy.inf
+        ld('tps grid round trip error',error.max())
+        if not error.max() <= max_error:
+            logging.warning('--tps-grid round trip error %g exceeds %g pixels, using the TPS transformer' %
+                            (error.max(),max_error))
+            return None
+        return warp_src_geoloc_transformer % dict(path=geoloc,step=step)
+
+    #############################
+
+    def base_compression(self,warp_ds):
+        'compression for the base raster, "auto" compares disk and deflate throughput'
+    #############################
+        compression=self.options.base_compression.upper()
+        if compression != 'AUTO':
+            return compression
+
+        # disk write throughput
+        test_file=os.path.join(self.dest,self.base+'.disk-test')
+        test_data='\xA5'*(16*1024*1024)
+        start=time.time()
+        with open(test_file,'wb') as f:
+            f.write(test_data)
+            f.flush()
+            os.fsync(f.fileno())
+        disk_time=time.time()-start
+        os.remove(test_file)
+        disk_rate=len(test_data)/max(disk_time,1e-6)
+
+        # deflate throughput and ratio on a sample warped from the raster center
+        tsx,tsy=self.tile_sz
+        w=min(warp_ds.RasterXSize,tsx*4)
+        h=min(warp_ds.RasterYSize,tsy*4)
+        sample=warp_ds.ReadRaster((warp_ds.RasterXSize-w)//2,(warp_ds.RasterYSize-h)//2,w,h)
+        start=time.time()
+        packed=zlib.compress(sample,1)
+        zlib.decompress(packed)
+        cpu_rate=len(sample)/max(time.time()-start,1e-6)
+        ratio=float(len(packed))/len(sample)
+
+        # per byte of the base raster: written once and read once
+        raw_cost=2/disk_rate
+        packed_cost=2*ratio/disk_rate+1/cpu_rate
+        ld('base_compression disk',disk_rate,'cpu',cpu_rate,'ratio',ratio,'costs',raw_cost,packed_cost)
+        return 'DEFLATE' if packed_cost < raw_cost else 'NONE'
+
+    #############################
+
+    def get_cutline(self):
+
+    #############################
+        src_ds=self.src_ds
+        src_proj=wkt2proj4(src_ds.GetProjection())
         cutline=src_ds.GetMetadataItem('CUTLINE')
         ld('cutline',cutline)
         if self.options.cutline:
@@ -910,12 +2350,86 @@ class Pyramid(object):
         'generate pyramid'
     #############################
 
+        stats.take() # drop the stats of a previous source
+        start_time=time.time()
+        start_cpu=sum(os.times()[:4])
+
         if not self.init_map(options.zoom):
             return
+        if self.options.shard is not None or self.options.reduce_shards:
+            self.init_shards()
 
         # reproject to base zoom
         self.make_base_raster()
 
+        Image.init()
+        self.tile_format=Image.EXTENSION[self.tile_ext]
+
+        # tile opacities are streamed to disk as the tiles are written
+        if self.options.mbtiles:
+            self.mbtiles=MBTiles(os.path.join(self.dest,self.base+'.mbtiles'),
+                                 self.zoom_tiles,self.options.commit_interval)
+            self.opacity_sink=self.mbtiles # opacities go into the same database
+        else:
+            self.mbtiles=None
+            opacity_path=os.path.join(self.dest, 'merge-cache')
+            self.stored_opacities=None
+            if self.options.update_region:
+                try: # opacities of the tiles left as they are
+                    self.stored_opacities=OpacityIndex(opacity_path)
+                except (IOError,ValueError,AssertionError,struct.error):
+                    logging.warning("no opacity cache to update: %s" % opacity_path)
+            self.opacity_sink=OpacitySink(opacity_path)
+            self.opacity_sink.recover()
+        self.dedup=TileDedup() if self.options.dedup else None
+        self.tile_writer=TileWriter(self.options.write_threads)
+
+        top_tiles=self.map_tiles()
+        self.tile_palette=self.init_palette()
+
+        if self.options.plan_shards:
+            self.plan_shards()
+            self.completed=True
+            return
+
+        if self.options.update_region:
+            # re-render the changed region only, the rest is read back from the output
+            self.update_tiles=self.region_tiles()
+            self.subtree_results={}
+            ld('update tiles',len(self.update_tiles))
+        else:
+            if self.options.reduce_shards:
+                self.gather_shards()
+            # render subtrees in parallel, the top levels are merged here
+            self.proc_subtrees()
+
+        if self.shard_roots is None: # a shard worker leaves the top levels to the reducer
+            top_results=filter(None,map(self.proc_tile,top_tiles))
+
+            # write top-level metadata (html/kml)
+            self.write_metadata(None,[ch for img,ch,opacity in top_results])
+            self.flush_metadata()
+        self.tile_writer.join()
+        if self.mbtiles and self.shard_roots is None:
+            with stats.stage('metadata'):
+                self.write_mbtiles_metadata()
+        
+        # cache back tiles opacity
+        try:
+            if self.mbtiles:
+                self.opacity_sink.close()
+            else:
+                self.opacity_sink.close(self.kept_opacities())
+        except:
+            logging.warning("opacity cache save failed")
+        self.write_stats(time.time()-start_time,sum(os.times()[:4])-start_cpu)
+        self.completed=True
+
+    #############################
+
+    def map_tiles(self):
+        'map "logical" tiles of all the zoom levels to "physical" ones, returns the top level tiles'
+    #############################
         self.tile_map={}
         for zoom in self.zoom_range:
             tile_ul,tile_lr=self.corner_tiles(zoom)
@@ -929,18 +2443,333 @@ class Pyramid(object):
             self.tile_map.update(level_map)
         ld('min_zoom',zoom,'tile_ul',tile_ul,'tile_lr',tile_lr,'tiles',level_map)
         self.all_tiles=frozenset(self.tile_map)
-        top_results=filter(None,map(self.proc_tile,level_map.keys()))
+        return level_map.keys()
 
-        # write top-level metadata (html/kml)
-        self.write_metadata(None,[ch for img,ch,opacities in top_results])
-        
-        # cache back tiles opacity
-        file_opacities=[(self.tile_path(tile),opc)
-            for tile,opc in flatten([opacities for img,ch,opacities in top_results])]
+    #############################
+
+    def write_stats(self,wall,cpu):
+        'per stage timing report'
+    #############################
+        report=dict(
+            source= self.src,
+            wall=   wall,
+            cpu=    cpu, # all the processes
+            stages= stats.report(),
+            )
+        tuned=[p.tuning for p in (self.layers or [self]) if p.tuning]
+        if tuned:
+            report['autotune']=tuned if self.layers else tuned[0]
+        with open(os.path.join(self.dest,'tiling-stats.json'),'w') as f:
+            json.dump(report,f,indent=1,sort_keys=True)
+        for stage,st in sorted(report['stages'].items()):
+            ld('stage',stage,st)
+
+    #############################
+
+    def init_palette(self):
+        'one palette for all the --paletted tiles, sampled from the base zoom'
+    #############################
+        if not (self.options.paletted and self.tile_ext == '.png') or self.palette is not None or numpy is None:
+            return None # per tile quantization, if any
+        stored=self.journal.get('palette') # keep existing tiles consistent
+        if stored is not None:
+            return TilePalette(stored[0])
+
+        base_tiles=sorted([t for t in self.all_tiles if t[0] == self.base_zoom])
+        step=max(1,len(base_tiles)//self.palette_sample_tiles)
+        images=[]
+        for tile in base_tiles[::step]:
+            img,opacity=self.base_img.tile(*self.tile_map[tile][1:])
+            if img is not None:
+                images.append(img)
+        ld('palette sample tiles',len(images))
+        tile_palette=TilePalette.from_sample(images)
+        self.journal.add('palette',tile_palette.palette)
+        return tile_palette
+
+    #############################
+
+    def region_tiles(self):
+        'tiles to update: base tiles intersecting the changed region and their ancestors'
+    #############################
+        z=self.base_zoom
+        zoom_dim=self.zoom_tiles(z)
+        base_tiles=set()
+        for ring in self.update_region():
+            if ring[0] != ring[-1]:
+                ring=ring+[ring[0]]
+            region=ogr.CreateGeometryFromWkt('POLYGON((%s))' % ','.join(['%r %r' % tuple(p[:2]) for p in ring]))
+            xs,ys=zip(*ring)[0:2]
+            t_ul=self.coord2tile(z,(min(xs),max(ys)))
+            t_lr=self.coord2tile(z,(max(xs),min(ys)))
+            for y in range(t_ul[2],t_lr[2]+1):
+                for x in range(t_ul[1],t_lr[1]+1):
+                    tile=(z,x%zoom_dim[0],y)
+                    if self.tile_map.get(tile) != (z,x,y): # outside of the pyramid
+                        continue
+                    (x0,y0),(x1,y1)=self.tile2coord_box((z,x,y))
+                    box=ogr.CreateGeometryFromWkt('POLYGON((%r %r,%r %r,%r %r,%r %r,%r %r))' % (
+                        x0,y0, x1,y0, x1,y1, x0,y1, x0,y0))
+                    if region.Intersects(box):
+                        base_tiles.add(tile)
+
+        tiles=set(base_tiles)
+        for zoom in self.zoom_range[1:]:
+            dz=z-zoom
+            tiles.update([(zoom,x>>dz,y>>dz) for _,x,y in base_tiles])
+        return tiles & self.all_tiles
+
+    #############################
+
+    def update_region(self):
+        'changed region as rings in the target SRS: a "lon,lat,lon,lat" box or an OGR datasource'
+    #############################
+        region=self.options.update_region
         try:
-            pickle.dump(dict(file_opacities),open(os.path.join(self.dest, 'merge-cache'),'w'))
-        except:
-            logging.warning("opacity cache save failed")
+            w,s,e,n=map(float,region.split(','))
+        except ValueError:
+            return self.shape2mpointlst(region,self.proj)
+        ring=[(w,n),(e,n),(e,s),(w,s),(w,n)]
+        return [MyTransformer(SRC_SRS=self.longlat,DST_SRS=self.proj).transform(ring)]
+
+    #############################
+
+    def stored_tile(self,tile):
+        'a tile outside of the updated region: read back from the output'
+    #############################
+        if self.mbtiles:
+            opacity=self.mbtiles.read_opacity(tile)
+        elif self.stored_opacities is not None:
+            opacity=self.stored_opacities.get(self.tile_key(tile))
+        else: # no opacity cache, assume the worst
+            opacity=-1 if os.path.exists(self.tile_file(tile)) else None
+        if not opacity:
+            return None
+        return self.read_tile(tile,opacity),tile,opacity
+
+    #############################
+
+    def kept_opacities(self):
+        'opacity records of the tiles left as they are by an update or rendered by the shard workers'
+    #############################
+        if self.shard_opacities:
+            indexes=[OpacityIndex(path) for path in self.shard_opacities]
+            return RecordReader(lambda: itertools.chain(*[index.records() for index in indexes]))
+        if self.update_tiles is None or self.stored_opacities is None:
+            return ()
+        stored=self.stored_opacities
+        updated=frozenset([tuple(self.tile_key(t)) for t in self.update_tiles])
+        return RecordReader(lambda: (r for r in stored.records() if r[:3] not in updated))
+
+    #############################
+
+    def remove_tile(self,tile):
+        'remove a tile emptied by an update'
+    #############################
+        if self.mbtiles:
+            self.mbtiles.remove_tile(tile)
+        else:
+            try:
+                os.remove(self.tile_file(tile))
+            except OSError:
+                pass
+
+    #############################
+
+    def split_zoom(self,min_subtrees=None):
+        'zoom level to split the pyramid into subtrees at'
+    #############################
+        if len(self.zoom_range) < 2:
+            return None
+        journal_zoom=self.journal.get('split')
+        if journal_zoom is not None: # stick to the subtrees of an interrupted run
+            return journal_zoom[0]
+        if self.options.subtree_zoom is not None:
+            assert self.options.subtree_zoom in self.zoom_range, 'Subtree zoom is out of the zoom range'
+            return self.options.subtree_zoom
+
+        # choose the topmost level with enough subtrees to keep all the workers busy
+        if min_subtrees is None:
+            min_subtrees=cpu_count()*4
+        for zoom in reversed(self.zoom_range[:-1]):
+            tile_ul,tile_lr=self.corner_tiles(zoom) # the tiles may be not mapped yet
+            ntiles=(tile_lr[1]-tile_ul[1]+1)*(tile_lr[2]-tile_ul[2]+1)
+            if ntiles >= min_subtrees:
+                break
+        ld('split_zoom',zoom,'subtrees',ntiles)
+        return zoom
+
+    #############################
+
+    def subtree_span(self):
+        'base zoom tiles across a subtree, None if the pyramid is not split'
+    #############################
+        zoom=self.split_zoom()
+        if zoom is None:
+            return None
+        return 2**(self.base_zoom-zoom)
+
+    #############################
+
+    def proc_subtrees(self):
+        'render subtrees below the split zoom in worker processes'
+    #############################
+        global subtree_pyramid
+
+        self.subtree_results={}
+        zoom=self.split_zoom()
+        if zoom is None:
+            return
+        if self.journal.get('split') is None:
+            self.journal.add('split',zoom)
+        self.subtree_zoom=zoom
+
+        # subtrees completed by an interrupted run are read back from the output
+        done=dict(((z,x,y),opacity) for z,x,y,opacity in self.journal.get_all('done'))
+        roots=[]
+        for tile in self.all_tiles:
+            if tile[0] != zoom:
+                continue
+            if self.shard_roots is not None and tile not in self.shard_roots:
+                continue
+            if tile in done:
+                opacity=done[tile]
+                self.subtree_results[tile]=(self.read_tile(tile,opacity),tile,opacity) if opacity else None
+            else:
+                roots.append(tile)
+        roots.sort(key=tile_quadkey) # the workers get runs of neighbouring subtrees
+        ld('subtrees',len(roots),'done',len(done))
+
+        subtree_pyramid=self # workers get it from the parent process
+        self.tile_writer.join()
+        self.opacity_sink.flush() # don't let the workers inherit buffered data
+        try:
+            results=parallel_map(proc_subtree,roots)
+        finally:
+            subtree_pyramid=None
+
+        for tile,(res,worker_stats) in zip(roots,results):
+            stats.merge(worker_stats)
+            if res is not None:
+                img_data,tile,opacity=res
+                res=(data2img(img_data),tile,opacity)
+            self.subtree_results[tile]=res
+
+    #############################
+
+    def sharded(self):
+        return bool(self.options.plan_shards or self.options.shard is not None or self.options.reduce_shards)
+
+    #############################
+
+    def manifest_path(self):
+        'the manifest is at the pyramid destination, shard workers render one level down'
+    #############################
+        dest=self.dest if self.options.shard is None else os.path.dirname(self.dest)
+        return os.path.join(dest,'shard-manifest.json')
+
+    #############################
+
+    def plan_shards(self):
+        'split the subtrees into shards for independent workers, write a manifest'
+    #############################
+        nshards=self.options.plan_shards
+        zoom=self.split_zoom(nshards*cpu_count()*4) # workers are assumed to be like this machine
+        assert zoom is not None, 'Too few zoom levels to split the pyramid into shards'
+
+        # quadtree order keeps the subtrees of a shard together
+        roots=sorted([t for t in self.all_tiles if t[0] == zoom],key=tile_quadkey)
+        nshards=min(nshards,len(roots))
+        manifest=dict(
+            signature=self.journal.get('start'),
+            split=zoom,
+            palette=self.tile_palette.palette if self.tile_palette else None,
+            shards=[roots[i*len(roots)//nshards:(i+1)*len(roots)//nshards] for i in range(nshards)],
+            )
+        with open(self.manifest_path(),'w') as f:
+            json.dump(manifest,f)
+        pf(' %d shards of %d subtrees at zoom %d' % (nshards,len(roots),zoom),end='')
+
+    #############################
+
+    def init_shards(self):
+        'shard worker or reducer: pick up the plan written by --plan-shards'
+    #############################
+        path=self.manifest_path()
+        with open(path) as f:
+            self.manifest=json.load(f)
+        assert self.manifest['signature'] == self.journal.get('start'), \
+            'Shard manifest %s is for other sources or options' % path
+        if self.journal.get('split') is None:
+            self.journal.add('split',self.manifest['split'])
+        if self.manifest['palette'] is not None and self.journal.get('palette') is None:
+            self.journal.add('palette',self.manifest['palette'])
+        if self.options.shard is not None:
+            assert 0 <= self.options.shard < len(self.manifest['shards']), 'No such shard: %d' % self.options.shard
+            self.shard_roots=frozenset([tuple(t) for t in self.manifest['shards'][self.options.shard]])
+
+    #############################
+
+    def gather_shards(self):
+        'reducer: move the shard outputs into the pyramid, the subtrees are marked as done'
+    #############################
+        done=set([tuple(e[:3]) for e in self.journal.get_all('done')])
+        for i,roots in enumerate(self.manifest['shards']):
+            shard_dir=os.path.join(self.dest,'shard-%d' % i)
+            shard_done=dict(((z,x,y),opacity) for z,x,y,opacity in
+                                Journal(os.path.join(shard_dir,'resume-journal')).get_all('done'))
+            missing=[t for t in roots if tuple(t) not in shard_done]
+            assert not missing, 'Shard %d is incomplete: %d subtrees are missing' % (i,len(missing))
+
+            # tiles and kml are below the shard directory, kmz archives at its top
+            for root,dirs,files in os.walk(shard_dir):
+                for f in files:
+                    if root == shard_dir and not f.endswith('.kmz'):
+                        continue
+                    src=os.path.join(root,f)
+                    dst=os.path.join(self.dest,os.path.relpath(src,shard_dir))
+                    try:
+                        os.makedirs(os.path.dirname(dst))
+                    except: pass
+                    os.rename(src,dst)
+
+            if self.mbtiles:
+                self.mbtiles.merge(os.path.join(shard_dir,self.base+'.mbtiles'))
+            else:
+                self.shard_opacities.append(os.path.join(shard_dir,'merge-cache'))
+            try:
+                with open(os.path.join(shard_dir,'tiling-stats.json')) as f:
+                    shard_stats=json.load(f)['stages']
+                stats.merge(dict([(stage,(st['calls'],st['bytes'],st['wall'],st['cpu']))
+                                    for stage,st in shard_stats.items()]))
+            except IOError:
+                pass
+
+            for tile,opacity in shard_done.items():
+                if tile not in done:
+                    self.journal.add('done',tile[0],tile[1],tile[2],opacity)
+        ld('shards gathered',len(self.manifest['shards']))
+
+    #############################
+
+    def read_tile(self,tile,opacity):
+        'read a tile back from the output'
+    #############################
+        if self.mbtiles:
+            return self.decode_tile(self.mbtiles.read_tile(tile),opacity)
+        with open(self.tile_file(tile),'rb') as f:
+            return self.decode_tile(f.read(),opacity)
+
+    #############################
+
+    def decode_tile(self,data,opacity):
+        'an encoded tile back to an image as rendered'
+    #############################
+        img=Image.open(StringIO(data))
+        img.load()
+        if self.palette is None: # undo paletted conversion if any
+            img=img.convert('RGBA' if opacity == -1 else 'RGB')
+        return img
 
     #############################
 
@@ -948,93 +2777,246 @@ class Pyramid(object):
 
     #############################
 
-        ch_opacities=[]
+        if tile in self.subtree_results: # already rendered by a worker
+            return self.subtree_results[tile]
+        if self.update_tiles is not None and tile not in self.update_tiles:
+            return self.stored_tile(tile)
+
         ch_results=[]
         zoom,x,y=tile
         if zoom==self.base_zoom: # get from the base image
             src_tile=self.tile_map[tile]
-            tile_img,opacity=self.base_img.tile(*src_tile[1:])
+            with stats.stage('base read'): # includes warping with a streamed base
+                tile_img,opacity=self.base_img.tile(*src_tile[1:])
             if tile_img and self.palette:
                 tile_img.putpalette(self.palette)
         else: # merge children
-            opacity=0
-            cz=self.zoom_range[self.zoom_range.index(zoom)-1] # child's zoom
-            dz=int(2**(cz-zoom))
-
-            ch_mozaic=dict(flatten(
-                [[((cz,x*dz+dx,y*dz+dy),(dx*self.tile_sz[0]//dz,dy*self.tile_sz[1]//dz))
-                               for dx in range(dz)]
-                                   for dy in range(dz)]))
+            dz,ch_mozaic=self.tile_children(tile)
             children=self.all_tiles & frozenset(ch_mozaic)
-            ch_results=filter(None,map(self.proc_tile,children))
+            # walked in the quadtree order, the base tiles are read sequentially when stored so
+            results=dict((ch,self.proc_tile(ch)) for ch in sorted(children,key=tile_quadkey))
+            ch_results=filter(None,[results[ch] for ch in children])
             #ld('tile',tile,'children',children,'ch_results',ch_results)
-            if len(ch_results) == 4 and all([opacities[0][1]==1 for img,ch,opacities in ch_results]):
-                opacity=1
-                mode_opacity=''
-            else:
-                opacity=-1
-                mode_opacity='A'
-
-            tile_img=None
-            for img,ch,opacity_lst in ch_results:
-                ch_img=img.resize([i//dz for i in img.size],self.resampling)
-                ch_mask=ch_img.split()[-1] if 'A' in ch_img.mode else None
-                
-                if tile_img is None:
-                    if 'P' in ch_img.mode:
-                        tile_mode='P'
-                    else:
-                        tile_mode=('L' if 'L' in ch_img.mode else 'RGB')+mode_opacity
-                    
-                    if self.transparency is not None:
-                        tile_img=Image.new(tile_mode,self.tile_sz,self.transparency)
-                    else:
-                        tile_img=Image.new(tile_mode,self.tile_sz)
-                    if self.palette is not None:
-                        tile_img.putpalette(self.palette)
-
-                tile_img.paste(ch_img,ch_mozaic[ch],ch_mask)
-                ch_opacities.extend(opacity_lst)
+            tile_img,opacity=self.overview_tile(tile,ch_results,dz,ch_mozaic)
 
         if tile_img is not None and opacity != 0:
             self.write_tile(tile,tile_img)
+            self.opacity_sink.write(self.tile_key(tile),opacity)
             
             # write tile-level metadata (html/kml)            
-            self.write_metadata(tile,[ch for img,ch,opacities in ch_results])
-            return tile_img,tile,[(tile,opacity)]+ch_opacities
+            self.write_metadata(tile,[ch for img,ch,opc in ch_results])
+            return tile_img,tile,opacity
+        elif self.update_tiles is not None:
+            self.tile_writer.put(self.remove_tile,tile)
 
     #############################
 
-    def write_tile(self,tile,tile_img):
+    def tile_children(self,tile):
+        'scale factor and offsets of the children at the next zoom of the range'
+    #############################
+        zoom,x,y=tile
+        cz=self.zoom_range[self.zoom_range.index(zoom)-1] # child's zoom
+        dz=int(2**(cz-zoom))
+
+        ch_mozaic=dict(flatten(
+            [[((cz,x*dz+dx,y*dz+dy),(dx*self.tile_sz[0]//dz,dy*self.tile_sz[1]//dz))
+                           for dx in range(dz)]
+                               for dy in range(dz)]))
+        return dz,ch_mozaic
 
     #############################
-        rel_path=self.tile_path(tile)
-        full_path=os.path.join(self.dest,rel_path)
-        try:
-            os.makedirs(os.path.dirname(full_path))
-        except: pass
 
-        if self.options.paletted and self.tile_ext == '.png':
-            try:
-                tile_img=tile_img.convert('P', palette=Image.ADAPTIVE, colors=255)
-            except ValueError:
-                #ld('tile_img.mode',tile_img.mode)
-                pass
+    def anchor_tile(self,tile):
+        'an overview tile warped from the source at an anchor zoom'
+    #############################
+        with stats.stage('anchor warp'):
+            tile_img,opacity=self.anchors[tile[0]].tile(*self.tile_map[tile][1:])
+        if tile_img and self.palette:
+            tile_img.putpalette(self.palette)
+        return tile_img,opacity
 
-        if self.transparency is not None:
-            tile_img.save(full_path,transparency=self.transparency)
+    #############################
+
+    def overview_tile(self,tile,ch_results,dz,ch_mozaic):
+        'an overview tile: warped at an anchor zoom, merged out of the children otherwise'
+    #############################
+        if tile[0] in self.anchors:
+            tile_img,opacity=self.anchor_tile(tile)
+            if opacity != 0 or not ch_results: # the children are not left without a parent
+                return tile_img,opacity
+        return self.merge_children(ch_results,dz,ch_mozaic)
+
+    #############################
+
+    def merge_children(self,ch_results,dz,ch_mozaic):
+        'build an overview tile out of the rendered children'
+    #############################
+        if len(ch_results) == 4 and all([opc==1 for img,ch,opc in ch_results]):
+            opacity=1
+            mode_opacity=''
         else:
-            tile_img.save(full_path)
-        
+            opacity=-1
+            mode_opacity='A'
+
+        with stats.stage('overview'):
+            tile_img=None
+            if ch_results:
+                ch_mode=ch_results[0][0].mode
+                if 'P' in ch_mode:
+                    tile_mode='P'
+                else:
+                    tile_mode=('L' if 'L' in ch_mode else 'RGB')+mode_opacity
+
+            if ch_results and numpy is not None and self.resampling in (Image.NEAREST,Image.BILINEAR):
+                # vectorized decimation or box filter (for bilinear), PIL does bicubic and antialias
+                tile_img=reduce_tiles([(img,ch_mozaic[ch],ch_opacity) for img,ch,ch_opacity in ch_results],
+                                      dz,self.tile_sz,tile_mode,self.resampling,self.transparency)
+                if self.palette is not None:
+                    tile_img.putpalette(self.palette)
+            else:
+                for img,ch,ch_opacity in ch_results:
+                    ch_img=img.resize([i//dz for i in img.size],self.resampling)
+                    ch_mask=ch_img.split()[-1] if 'A' in ch_img.mode else None
+
+                    if tile_img is None:
+                        if self.transparency is not None:
+                            tile_img=Image.new(tile_mode,self.tile_sz,self.transparency)
+                        else:
+                            tile_img=Image.new(tile_mode,self.tile_sz)
+                        if self.palette is not None:
+                            tile_img.putpalette(self.palette)
+
+                    tile_img.paste(ch_img,ch_mozaic[ch],ch_mask)
+        return tile_img,opacity
+
+    #############################
+
+    def write_tile(self,tile,tile_img):
+
+    #############################
+        saved=None
+        if self.dedup is not None:
+            key,first=self.dedup.find(tile_img)
+            if first: # the same pixels are written already, skip encoding
+                self.tile_writer.put(self.link_tile,first,tile)
+                self.counter()
+                return
+            saved=threading.Event() # to be set as soon as the tile is stored
+            self.dedup.add(key,(tile,saved))
+
+        self.tile_writer.put(self.save_tile,tile_img,tile,saved)
         self.counter()
 
     #############################
 
+    def save_tile(self,tile_img,tile,saved=None):
+        'convert, encode and store a tile, may be called from a writer thread'
+    #############################
+        try:
+            data=self.encode_tile(tile_img)
+
+            with stats.stage('write',len(data)):
+                if self.mbtiles:
+                    self.mbtiles.store_tile(tile,data)
+                else:
+                    full_path=self.tile_file(tile)
+                    try:
+                        os.makedirs(os.path.dirname(full_path))
+                    except: pass
+                    if self.reused_dest and os.path.exists(full_path):
+                        os.remove(full_path) # may be hard linked to other tiles
+                    with open(full_path,'wb') as f:
+                        f.write(data)
+        finally:
+            if saved is not None:
+                saved.set()
+
+    #############################
+
+    def encode_tile(self,tile_img):
+        'convert a tile as per the options and encode it into the tile format'
+    #############################
+        with stats.stage('encode') as st:
+            save_options={}
+            if self.tile_palette is not None:
+                tile_img=self.tile_palette.quantize(tile_img)
+                if 'transparency' in tile_img.info:
+                    save_options['transparency']=tile_img.info['transparency']
+            elif self.options.paletted and self.tile_ext == '.png':
+                try:
+                    tile_img=tile_img.convert('P', palette=Image.ADAPTIVE, colors=255)
+                except ValueError:
+                    #ld('tile_img.mode',tile_img.mode)
+                    pass
+
+            if self.transparency is not None:
+                save_options['transparency']=self.transparency
+
+            buf=StringIO()
+            tile_img.save(buf,self.tile_format,**save_options)
+            data=buf.getvalue()
+            st.nbytes=len(data)
+        return data
+
+    #############################
+
+    def link_tile(self,first,tile):
+        'link a tile to the first one with the same pixels'
+    #############################
+        first_tile,saved=first
+        saved.wait() # a writer thread may still be encoding it
+        with stats.stage('write'):
+            if self.mbtiles:
+                self.mbtiles.link_tile(first_tile,tile)
+            else:
+                full_path=self.tile_file(tile)
+                try:
+                    os.makedirs(os.path.dirname(full_path))
+                except: pass
+                if self.reused_dest and os.path.exists(full_path):
+                    os.remove(full_path)
+                link_file(self.tile_file(first_tile),full_path)
+
+    #############################
+
+    def tile_file(self,tile):
+        'full path to a tile file'
+    #############################
+        return os.path.join(self.dest,self.tile_path(tile))
+
+    #############################
+
+    def tile_key(self,tile):
+        'tile numbers as stored: in a tile path or in an MBTiles row'
+    #############################
+        if self.mbtiles:
+            return self.mbtiles.tile_key(tile)
+        return path2tile(self.tile_path(tile))
+
+    #############################
+
+    def write_mbtiles_metadata(self):
+
+    #############################
+        ul,lr=self.boxes2longlat([(self.origin,self.extent)])[0]
+        self.mbtiles.set_metadata(
+            name=       self.base,
+            type=       'overlay',
+            version=    '1.1',
+            description=os.path.basename(self.src),
+            format=     self.tile_ext[1:],
+            bounds=     '%f,%f,%f,%f' % (ul[0],lr[1],lr[0],ul[1]),
+            minzoom=    self.zoom_range[-1],
+            maxzoom=    self.zoom_range[0],
+            )
+
+    #############################
+
     def map_tiles2longlat_boxes(self,tiles):
         'translate "logical" tiles to latlong boxes'
     #############################
         # via 'logical' to 'physical' tile mapping
-        return self.boxes2longlat([self.tile2coord_box(self.tile_map[t]) for t in tiles])
+        return self.boxes2longlat(self.grid.tiles2coord_boxes([self.tile_map[t] for t in tiles]))
 
     #############################
 
@@ -1059,6 +3041,35 @@ class Pyramid(object):
     #############################
         pass # 'virtual'
 
+    #############################
+
+    def flush_metadata(self):
+        'hand the metadata buffered by write_metadata() over to the writer'
+    #############################
+        pass # 'virtual'
+
+    #############################
+
+    def begin_subtree(self,root):
+        'page in the base tiles of a subtree ahead of its walk'
+    #############################
+        z,x,y=root
+        dz=self.base_zoom-z
+        tile_ul,tile_lr=self.corner_tiles(self.base_zoom)
+        zoom_dim=self.zoom_tiles(self.base_zoom)
+        # the base tiles are as in the base raster, x may be wrapped around
+        xs=[bx for bx in range(tile_ul[1],tile_lr[1]+1) if (bx % zoom_dim[0])>>dz == x]
+        ys=range(max(y<<dz,tile_ul[2]),min((y+1)<<dz,tile_lr[2]+1))
+        self.base_img.prefetch([(bx,by) for by in ys for bx in xs])
+
+    #############################
+
+    def end_subtree(self):
+        'make sure everything of a subtree is written'
+    #############################
+        self.flush_metadata()
+        self.tile_writer.join()
+
     tick_rate=50
     count=0
     def counter(self):
@@ -1092,7 +3103,7 @@ class Pyramid(object):
         print()
 
     def zoom2res(self,zoom):
-        return map(lambda res: res/2**zoom, self.zoom0_res)
+        return self.grid.res[zoom]
 
     def res2zoom_xy(self,res):
         'resolution to zoom levels (separate for x and y)'
@@ -1118,21 +3129,17 @@ class Pyramid(object):
 
     def tile2coord_box(self,tile):
         'cartesian coordinates of tile corners'
-        z=tile[0]
-        return map(self.pix2coord,(z,z),self.tile_corners(tile))
+        return self.grid.tile2coord_box(tile)
 
     def coord2pix(self,zoom,coord):
         'cartesian coordinates to pixel coordinates'
-        ul_distance=(coord[0]+self.coord_offset[0],self.coord_offset[1]-coord[1])
-        out=tuple([int(dist/res) for dist,res in zip(ul_distance,self.zoom2res(zoom))])
-        return out
+        return self.grid.coord2pix(zoom,coord)
 
     def pix2coord(self,zoom,pix_coord):
-        pix00_ofs=map(operator.mul,pix_coord,self.zoom2res(zoom))
-        return [pix00_ofs[0]-self.coord_offset[0],-(pix00_ofs[1]-self.coord_offset[1])]
+        return self.grid.pix2coord(zoom,pix_coord)
 
     def zoom_tiles(self,zoom):
-        return map(lambda v: v*2**zoom,self.zoom0_tiles)
+        return self.grid.ntiles[zoom]
 
     def coords2longlat(self, coords): # redefined in PlateCarree
         longlat=[i[:2] for i in self.proj2geog.transform(coords)]
@@ -1141,31 +3148,24 @@ class Pyramid(object):
         return longlat
 
     def boxes2longlat(self,box_lst):
-        deg_lst=self.coords2longlat(flatten(box_lst))
-        ul_lst=deg_lst[0::2]
-        lr_lst=deg_lst[1::2]
-        res=[[
-            (ul[0] if ul[0] <  180 else ul[0]-360,ul[1]),
-            (lr[0] if lr[0] > -180 else lr[0]+360,lr[1]),
-            ] for ul,lr in zip(ul_lst,lr_lst)]
-        return res
+        if numpy is None or len(box_lst) < TileGrid.bulk_min:
+            deg_lst=self.coords2longlat(flatten(box_lst))
+            ul_lst=deg_lst[0::2]
+            lr_lst=deg_lst[1::2]
+            res=[[
+                (ul[0] if ul[0] <  180 else ul[0]-360,ul[1]),
+                (lr[0] if lr[0] > -180 else lr[0]+360,lr[1]),
+                ] for ul,lr in zip(ul_lst,lr_lst)]
+            return res
+        coords=numpy.asarray(box_lst,float).reshape(-1,2)
+        deg=numpy.array(self.coords2longlat(coords.tolist()),float).reshape(-1,2,2)
+        ul_lon,lr_lon=deg[:,0,0],deg[:,1,0] # views
+        ul_lon[ul_lon >= 180]-=360
+        lr_lon[lr_lon <= -180]+=360
+        return deg.tolist()
 
     def corner_tiles(self,zoom):
-        p_ul=self.coord2pix(zoom,self.origin)
-        t_ul=self.pix2tile(zoom,(p_ul[0]+1,p_ul[1]+1))
-
-        p_lr=self.coord2pix(zoom,self.extent)
-        t_lr=self.pix2tile(zoom,(p_lr[0]-1,p_lr[1]-1))
-
-        nztiles=self.zoom_tiles(zoom)
-        box_ul,box_lr=[self.tile2coord_box(t) for t in (t_ul,t_lr)]
-        ld('corner_tiles zoom',zoom,
-            'zoom tiles',nztiles,
-            'zoom pixels',map(lambda zt,ts:zt*ts,nztiles,self.tile_sz),
-            'p_ul',p_ul,'p_lr',p_lr,'t_ul',t_ul,'t_lr',t_lr,
-            'longlat', self.coords2longlat([box_ul[0],box_lr[1]])
-            )
-        return t_ul,t_lr
+        return self.grid.corner_tiles(zoom,self.origin,self.extent)
 
     def belongs_to(self,tile):
         zoom,x,y=tile
@@ -1277,23 +3277,55 @@ class PlateCarree(Pyramid):
     proj='+proj=eqc +datum=WGS84 +ellps=WGS84'
 
     def coords2longlat(self, coords):
-        out=[map(lambda c,res0,tsz,c_off: (((c+c_off)/(res0*tsz)*180)+180)%360-180,
-                coord,self.zoom0_res,self.tile_sz,(self.shift_x,0)) for coord in coords]
-        return [(lon,lat) for lon,lat in out]
+        if numpy is None or len(coords) < TileGrid.bulk_min:
+            out=[map(lambda c,res0,tsz,c_off: (((c+c_off)/(res0*tsz)*180)+180)%360-180,
+                    coord,self.zoom0_res,self.tile_sz,(self.shift_x,0)) for coord in coords]
+            return [(lon,lat) for lon,lat in out]
+        coords=numpy.asarray(coords,float)[:,:2]
+        zoom0_dim=numpy.array(self.zoom0_res)*self.tile_sz
+        out=((coords+(self.shift_x,0))/zoom0_dim*180+180)%360-180
+        return out.tolist()
 
-    def kml_child_links(self,children,parent=None,path_prefix=''):
+    kml_batch=256 # tiles per a batch of kml documents
+
+    def __init__(self,src=None,dest=None,options=None):
+        super(PlateCarree, self).__init__(src,dest,options)
+        self.kml_pending=[]
+        self.kmz=None
+        self.kmz_docs=0
+        self.kmz_lock=threading.Lock() # writer threads share an archive
+
+    def kmz_zoom(self):
+        'zoom of the tiles at the roots of kmz archives'
+        return self.subtree_zoom if self.options.kmz else None
+
+    def kml_name(self,tile):
+        return os.path.splitext(self.tile_path(tile))[0]
+
+    def kml_href(self,tile,path_prefix):
+        'link to a tile kml: a file, a kmz archive or a document in the same archive'
+        name=self.kml_name(tile)
+        kmz_zoom=self.kmz_zoom()
+        if kmz_zoom is None or tile[0] < kmz_zoom:
+            return path_prefix+name+'.kml'
+        flat_name=name.replace('/','-')
+        if tile[0] == kmz_zoom:
+            return path_prefix+flat_name+'.kmz'
+        return flat_name+'.kml'
+
+    def kml_child_links(self,children,parent=None,path_prefix='',boxes=None):
         kml_links=[]
         # convert tiles to degree boxes
-        longlat_boxes=self.map_tiles2longlat_boxes(children)
+        if boxes is None:
+            boxes=dict(zip(children,self.map_tiles2longlat_boxes(children)))
         
-        for tile,longlat in zip(children,longlat_boxes):
-            #ld(tile,longlat)
-            w,n,e,s=['%.11f'%v for v in flatten(longlat)]
-            name=os.path.splitext(self.tile_path(tile))[0]
+        for tile in children:
+            #ld(tile,boxes[tile])
+            w,n,e,s=['%.11f'%v for v in flatten(boxes[tile])]
             # fill in kml link template
             kml_links.append( kml_link_templ % { 
-                'name':    name,
-                'href':    path_prefix+'%s.kml' % name,
+                'name':    self.kml_name(tile),
+                'href':    self.kml_href(tile,path_prefix),
                 'west':    w, 'north':    n,
                 'east':    e, 'south':    s,
                 'min_lod': 128,
@@ -1301,37 +3333,94 @@ class PlateCarree(Pyramid):
                 })
         return ''.join(kml_links)
 
-    def write_kml(self,rel_path,name,links='',overlay=''):
-        kml= kml_templ % {
+    def render_kml(self,name,links='',overlay=''):
+        return kml_templ % {
             'name':      name,
             'links':     links,
             'overlay':   overlay,
             'dbg_start': '' if options.verbose < 2 else '    <!--\n',
             'dbg_end':   '' if options.verbose < 2 else '      -->\n',
             }
-        open(os.path.join(self.dest,rel_path+'.kml'),'w+').write(kml)
+
+    def write_kml(self,rel_path,name,links='',overlay=''):
+        open(os.path.join(self.dest,rel_path+'.kml'),'w+').write(self.render_kml(name,links,overlay))
+
+    def write_kml_docs(self,docs,archive=None):
+        'write a batch of kml documents, may be called from a writer thread'
+        with stats.stage('metadata'):
+            if archive is not None:
+                with self.kmz_lock:
+                    for name,kml in docs:
+                        archive.writestr(name+'.kml',kml)
+                return
+            for name,kml in docs:
+                path=os.path.join(self.dest,name+'.kml')
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except: pass
+                with open(path,'w') as f:
+                    f.write(kml)
 
     def write_metadata(self,tile,children=[]): #
         if not tile: # create top level kml
-            self.write_kml(os.path.basename(self.base),os.path.basename(self.base),self.kml_child_links(children))
+            self.flush_metadata()
+            with stats.stage('metadata'):
+                self.write_kml(os.path.basename(self.base),os.path.basename(self.base),self.kml_child_links(children))
             return
-        # fill in kml templates
-        rel_path=self.tile_path(tile)
-        name=os.path.splitext(rel_path)[0]
-        kml_links=self.kml_child_links(children,tile,'../../')
-        tile_box=self.map_tiles2longlat_boxes([tile])[0]
-        w,n,e,s=['%.11f'%v for v in flatten(tile_box)]
-        kml_overlay = kml_overlay_templ % {
-            'name':    name,
-            'href':    os.path.basename(rel_path),
-            'min_lod': 128,
-            'max_lod': 2048 if kml_links else -1,
-            'order':   tile[0],
-            'west':    w, 'north':    n,
-            'east':    e, 'south':    s,
-            }
-        self.write_kml(name,name,kml_links,kml_overlay)
-            
+        # tile kmls are rendered in batches
+        self.kml_pending.append((tile,children))
+        if len(self.kml_pending) >= self.kml_batch:
+            self.flush_metadata()
+
+    def flush_metadata(self):
+        pending,self.kml_pending=self.kml_pending,[]
+        if not pending:
+            return
+        with stats.stage('metadata'): # the writing is timed by write_kml_docs(), it may run on a writer thread
+            # degree boxes for the whole batch at once
+            tiles=[tile for tile,children in pending]+flatten([children for tile,children in pending])
+            boxes=dict(zip(tiles,self.map_tiles2longlat_boxes(tiles)))
+
+            in_kmz=self.kmz is not None
+            docs=[]
+            for tile,children in pending:
+                # fill in kml templates
+                rel_path=self.tile_path(tile)
+                name=self.kml_name(tile)
+                kml_links=self.kml_child_links(children,tile,'' if in_kmz else '../../',boxes)
+                w,n,e,s=['%.11f'%v for v in flatten(boxes[tile])]
+                kml_overlay = kml_overlay_templ % {
+                    'name':    name,
+                    'href':    '../'+rel_path if in_kmz else os.path.basename(rel_path), # "../" leaves an archive
+                    'min_lod': 128,
+                    'max_lod': 2048 if kml_links else -1,
+                    'order':   tile[0],
+                    'west':    w, 'north':    n,
+                    'east':    e, 'south':    s,
+                    }
+                docs.append((name.replace('/','-') if in_kmz else name,self.render_kml(name,kml_links,kml_overlay)))
+        self.kmz_docs+=len(docs)
+        self.tile_writer.put(self.write_kml_docs,docs,self.kmz)
+
+    def begin_subtree(self,root):
+        super(PlateCarree, self).begin_subtree(root)
+        self.kmz_docs=0
+        if self.kmz_zoom() is None:
+            return
+        # a subtree goes into an archive, doc.kml (the first document) links to the root tile
+        flat_name=self.kml_name(root).replace('/','-')
+        self.kmz=zipfile.ZipFile(os.path.join(self.dest,flat_name+'.kmz'),'w',zipfile.ZIP_DEFLATED,
+            allowZip64=True)
+        self.kmz.writestr('doc.kml',kmz_doc_templ % {'name': flat_name,'href': flat_name+'.kml'})
+
+    def end_subtree(self):
+        super(PlateCarree, self).end_subtree()
+        if self.kmz is not None:
+            self.kmz.close()
+            if not self.kmz_docs: # empty subtree
+                os.remove(self.kmz.filename)
+            self.kmz=None
+
 # PlateCarree
 
 #############################
@@ -1376,6 +3465,18 @@ kml_overlay_templ='''
             </LatLonBox>
         </GroundOverlay>'''
 
+kmz_doc_templ='''<?xml version="1.0" encoding="utf-8"?>
+<kml xmlns="http://earth.google.com/kml/2.1">
+    <Document>
+        <name>%(name)s</name>
+        <NetworkLink>
+            <name>%(name)s</name>
+            <Link> <href>%(href)s</href> </Link>
+        </NetworkLink>
+    </Document>
+</kml>
+'''
+
 kml_link_templ='''
         <NetworkLink>
             <name>%(name)s</name>
@@ -1418,7 +3519,8 @@ class Gmaps(Pyramid):
 
     def write_metadata(self,tile,children=[]): 
         if not tile: # create top level html
-            self.write_html_maps()
+            with stats.stage('metadata'):
+                self.write_html_maps()
 
     def write_html_maps(self):
         ul,lr=self.boxes2longlat([(self.origin,self.extent)])[0]
@@ -1587,19 +3689,53 @@ profile_map=(
     GenericMap,
     )
 
+subtree_pyramid=None
+stats=StageStats()
+
+def proc_subtree(tile):
+    'render a pyramid subtree in a worker process'
+    try:
+        subtree_pyramid.begin_subtree(tile)
+        res=subtree_pyramid.proc_tile(tile)
+        # worker processes exit without a cleanup
+        subtree_pyramid.end_subtree()
+        subtree_pyramid.opacity_sink.flush()
+        subtree_pyramid.journal.add('done',tile[0],tile[1],tile[2],res[2] if res else 0)
+    except KeyboardInterrupt: # http://jessenoller.com/2009/01/08/multiprocessingpool-and-keyboardinterrupt/
+        pf('got KeyboardInterrupt')
+        raise KeyboardInterruptError()
+    if res is not None:
+        img,tile,opacity=res
+        res=img2data(img),tile,opacity
+    return res,stats.take() # stats are summed up by the parent
+
+def shard_dest(dest):
+    'a shard worker renders into its own directory inside of the destination'
+    if options.shard is None:
+        return dest
+    return os.path.join(dest,'shard-%d' % options.shard)
+
 def proc_src(src):
     cls=Pyramid.profile_class(options.profile)
     ext= cls.defaul_ext if options.strip_dest_ext is None else ''
-    dest=dest_path(src,options.dest_dir,ext)
+    dest=shard_dest(dest_path(src,options.dest_dir,ext))
     #
     cls(src,dest,options).walk_pyramid()
 
-#############################
-
-def main(argv):
+def proc_mosaic(sources):
+    'render all of the sources into one pyramid'
+    cls=Pyramid.profile_class(options.profile)
+    ext= cls.defaul_ext if options.strip_dest_ext is None else ''
+    dest=shard_dest(dest_path(options.mosaic,options.dest_dir,ext))
+    #
+    pyramid=cls(sources[0],dest,options)
+    pyramid.mosaic=sources
+    pyramid.walk_pyramid()
 
 #############################
-    
+
+def option_parser():
+    'command line options, shared with the tile server'
     parser = OptionParser(
         usage = "usage: %prog <options>... input_file...",
         version=version,
@@ -1635,6 +3771,9 @@ def main(argv):
         help='cutline data: OGR datasource')
     parser.add_option("--cutline-blend", dest="blend_dist",default=None,metavar="N",
         help='CUTLINE_BLEND_DIST in pixels')
+    parser.add_option("--tps-grid", type='float', default=None, metavar="MAX_ERROR",
+        help='GCP sources: interpolate the thin plate spline from a grid evaluated once, '
+        'with the error bound in source pixels (e.g. 0.125)')
     parser.add_option("--src-nodata", dest="src_nodata", metavar='N[,N]...',
         help='Nodata values for input bands')
     parser.add_option("--dst-nodata", dest="dst_nodata", metavar='N',
@@ -1645,17 +3784,74 @@ def main(argv):
         help='tile image format (default: PNG)')
     parser.add_option("--paletted", action="store_true", 
         help='convert tiles to paletted format (8 bit/pixel)')
+    parser.add_option("--mbtiles", action="store_true",
+        help='write tiles, opacities and metadata into an MBTiles database at the destination directory')
+    parser.add_option("--commit-interval", type='int', default=1000, metavar="N",
+        help='MBTiles: commit a transaction every N rows (default: 1000)')
+    parser.add_option("--write-threads", type='int', default=0, metavar="N",
+        help='encode and write tiles in N background threads (default: 0, write in line)')
+    parser.add_option("--dedup", action="store_true", 
+        help='hard link tiles with identical pixels to the first such tile instead of encoding them again')
+    parser.add_option("--kmz", action="store_true",
+        help='earth profiles: pack the kml files of each subtree into a kmz archive')
+    parser.add_option("--mosaic", default=None, metavar="NAME",
+        help='render all of the sources into a single pyramid NAME in one pass, '
+        'stacked as by tiles_merge: the last source is on top')
     parser.add_option("-t", "--dest-dir", dest="dest_dir", default=None,
         help='destination directory (default: source)')
     parser.add_option("--noclobber", action="store_true", 
         help='skip processing if the target pyramyd already exists')
     parser.add_option("-s", "--strip-dest-ext", action="store_true",
         help='do not add a default extension suffix from a destination directory')
+    parser.add_option("--base-compression", default='none',metavar="METHOD",
+        choices=('none','deflate','packbits','auto'),
+        help='compression of the intermediate base raster: none, deflate, packbits or auto (default: none)')
+    parser.add_option("--base-interleave", default='band',metavar="LAYOUT",
+        choices=('band','pixel'),
+        help='layout of the intermediate base raster: band or pixel, pixel keeps a tile in one piece (default: band)')
+    parser.add_option("--base-order", default='rows',metavar="ORDER",
+        choices=('rows','quadtree'),
+        help='tile order of the intermediate base raster: rows or quadtree, quadtree costs a copy of the raster '
+        'but the subtrees read it sequentially, worth it when it does not fit into RAM (default: rows)')
+    parser.add_option("--anchors", default=None, metavar="ZOOM_LIST",
+        help='warp these overview zooms straight from the source (using its overviews) rather than '
+        'building them out of the children, "auto" picks them by the zoom range and the source overviews')
+    parser.add_option("--stream-base", action="store_true",
+        help='warp base zoom tiles on demand, without an intermediate base raster')
+    parser.add_option("--metatile", type='int', default=1, metavar="N",
+        help='streamed base: warp blocks of NxN tiles at once and slice them, N is best a power of 2 (default: 1)')
+    parser.add_option("--autotune", action="store_true",
+        help='pick the GDAL block cache, warp memory, warp threads and metatile size '
+        'from the rasters and the free memory, check the threads with a calibration warp')
+    parser.add_option("--resume", action="store_true", 
+        help='continue an interrupted run: reuse the base raster and the completed subtrees')
+    parser.add_option("--update-region", default=None, metavar="REGION",
+        help='re-render only the tiles of an existing pyramid touched by a changed region: '
+        '"lon_min,lat_min,lon_max,lat_max" or an OGR datasource with a polygon')
+    parser.add_option("--subtree-zoom", type='int', default=None, metavar="ZOOM",
+        help='zoom level to split a pyramid into subtrees rendered in parallel (default: automatic)')
+    parser.add_option("--plan-shards", type='int', default=None, metavar="N",
+        help='split the job into N shards for independent workers: write shard-manifest.json '
+        'at the destination and exit')
+    parser.add_option("--shard", type='int', default=None, metavar="K",
+        help='render shard K of the manifest into the shard-K directory at the destination')
+    parser.add_option("--reduce-shards", action="store_true",
+        help='gather the rendered shards into the pyramid, build the top levels and the metadata')
+    parser.add_option("--nothreads", action="store_true",
+        help="do not use multiprocessing")
     parser.add_option("-q", "--quiet", action="store_const", 
         const=0, default=1, dest="verbose")
     parser.add_option("-d", "--debug", action="store_const", 
         const=2, dest="verbose")
+    return parser
+
+#############################
+
+def main(argv):
+
+#############################
 
+    parser=option_parser()
     global options
     (options, args) = parser.parse_args(argv[1:])
     
@@ -1672,6 +3868,21 @@ def main(argv):
     if options.release:
         options.overview_resampling,options.base_resampling=('antialias','bilinear')
 
+    if options.nothreads:
+        set_nothreads()
+
+    if len(filter(None,(options.plan_shards,options.shard is not None,options.reduce_shards,options.update_region))) > 1:
+        parser.error('--plan-shards, --shard, --reduce-shards and --update-region are separate steps')
+
+    if options.metatile < 1:
+        parser.error('--metatile must be 1 or more')
+
+    if options.anchors not in (None,'auto') and not re.match(r'^\d+(,\d+)*$',options.anchors):
+        parser.error('--anchors is either "auto" or a comma separated list of zooms')
+
+    if options.kmz and options.update_region:
+        parser.error('--kmz archives can not be updated in place, use plain kml files with --update-region')
+
     if not args:
         parser.error('No input file(s) specified')
     try:
@@ -1679,7 +3890,10 @@ def main(argv):
     except:
         raise Exception("No sources specified")
 
-    parallel_map(proc_src,sources)
+    if options.mosaic:
+        proc_mosaic(sources)
+    else:
+        parallel_map(proc_src,sources)
     pf('')
 
 # main()
@@ -38,6 +38,13 @@ from subprocess import *
 import itertools
 import re
 import shutil
+import glob
+import mmap
+import struct
+import bisect
+import heapq
+import time
+import threading
 #from optparse import OptionParser
 
 try:
@@ -64,8 +71,34 @@ def set_nothreads():
     global multiprocessing
     multiprocessing=None
 
+def parallel_enabled():
+    'check if a process pool can be started from here'
+    # pool workers are daemonic and are not allowed to have children
+    return multiprocessing is not None and not multiprocessing.current_process().daemon
+
+def cpu_count():
+    'number of processes to run in parallel'
+    try:
+        return multiprocessing.cpu_count()
+    except:
+        return 1
+
+def available_memory():
+    'free RAM in bytes, None if unknown'
+    try:
+        with open('/proc/meminfo') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    return int(l.split()[1])*1024
+    except (IOError,ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError,ValueError,OSError):
+        return None
+
 def parallel_map(func,iterable):
-    if multiprocessing is None or len(iterable) < 2:
+    if not parallel_enabled() or len(iterable) < 2:
         return map(func,iterable)
     else:
         # map in parallel
@@ -76,6 +109,48 @@ def parallel_map(func,iterable):
         mp_pool.join()
     return res
 
+try: # per thread CPU time, the stages may run in writer threads
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_=[('tv_sec',ctypes.c_long),('tv_nsec',ctypes.c_long)]
+
+    _clock_gettime=ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c')).clock_gettime
+    _clock_gettime.argtypes=[ctypes.c_int,ctypes.POINTER(_timespec)]
+    CLOCK_THREAD_CPUTIME_ID=3 # Linux
+
+    def thread_cpu_time():
+        ts=_timespec()
+        if _clock_gettime(CLOCK_THREAD_CPUTIME_ID,ctypes.byref(ts)) != 0:
+            return time.clock()
+        return ts.tv_sec+ts.tv_nsec*1e-9
+except (ImportError,OSError,AttributeError,TypeError):
+    thread_cpu_time=time.clock # process CPU time
+
+MADV_WILLNEED=3
+
+try: # mmap objects have no madvise() in python 2
+    _madvise=ctypes.CDLL(ctypes.util.find_library('c')).madvise
+    _madvise.argtypes=[ctypes.c_void_p,ctypes.c_size_t,ctypes.c_int]
+    _as_read_buffer=ctypes.pythonapi.PyObject_AsReadBuffer
+    _as_read_buffer.argtypes=[ctypes.py_object,ctypes.POINTER(ctypes.c_void_p),ctypes.POINTER(ctypes.c_ssize_t)]
+    _page_size=mmap.PAGESIZE
+
+    def madvise(mapping,offset,length,advice):
+        'a paging hint for a range of an mmap object, a no-op where unsupported'
+        addr=ctypes.c_void_p()
+        size=ctypes.c_ssize_t()
+        if _as_read_buffer(mapping,ctypes.byref(addr),ctypes.byref(size)) != 0:
+            return
+        start=offset-offset % _page_size # page aligned
+        end=min(offset+length,size.value)
+        if end > start:
+            _madvise(addr.value+start,end-start,advice)
+except (NameError,OSError,AttributeError,TypeError):
+    def madvise(mapping,offset,length,advice):
+        pass
+
 def ld(*parms):
     logging.debug(' '.join(itertools.imap(repr,parms)))
 
@@ -141,6 +216,13 @@ def dest_path(src,dest_dir,ext='',template='%s'):
     ld(base,dest)
     return dest
     
+def link_file(src,dst):
+    'hard link a file, copy it where links are not supported'
+    try:
+        os.link(src,dst)
+    except (AttributeError,OSError):
+        shutil.copyfile(src,dst)
+
 def re_sub_file(fname, subs_list):
     'stream edit file using reg exp substitution list'
     new=fname+'.new'
@@ -195,3 +277,315 @@ class MyTransformer(gdal.Transformer):
     def transform_point(self,point,inv=False):
         return self.transform([point],inv=inv)[0]
 
+#############################
+#
+# tile opacity cache (merge-cache)
+#
+#############################
+
+def path2tile(tile_path):
+    'tile numbers (z,x,y) from a z/x/y.ext tile path'
+    z,x,y=path2list(tile_path)[-4:-1]
+    return int(z),int(x),int(y)
+
+class OpacityRuns(object):
+    'runs of the tiles of a zoom level as a read-only sequence of their first keys over the mapped index'
+    run_fmt='<QII' # key (y<<32|x) of the first tile, number of tiles, index of the first tile
+    run_len=struct.calcsize(run_fmt)
+
+    def __init__(self,buf,ofs,count):
+        self.buf,self.ofs,self.count=buf,ofs,count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self,i):
+        return struct.unpack_from('<Q',self.buf,self.ofs+i*self.run_len)[0]
+
+    def run(self,i):
+        return struct.unpack_from(self.run_fmt,self.buf,self.ofs+i*self.run_len)
+
+class OpacityIndex(object):
+    '''Memory-mapped tile opacity index
+
+    The tiles of each zoom level are stored as sorted runs of adjacent tiles in a row
+    followed by the tile codes, 2 bits per tile: 1 - transparent, 2 - opaque, 3 - semi-transparent.
+    '''
+
+    magic='TOPX'
+    version=3
+    hdr_fmt='<4sII'     # magic, version, number of zoom levels
+    zoom_fmt='<IQQQQ'   # zoom, number of runs, runs offset, number of tiles, codes offset
+    rec_fmt='<IQQb'     # zoom, key, sequence number, code: a record being sorted
+    sort_chunk=1<<18    # records sorted in memory at once
+    codes={0:1, 1:2, -1:3}
+    opacities=(None,0,1,-1)
+
+    def __init__(self,path):
+        self.path=path
+        self.file=open(path,'rb')
+        self.mmap=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        magic,version,nzooms=struct.unpack_from(self.hdr_fmt,self.mmap,0)
+        assert magic == self.magic and version == self.version, 'Invalid opacity index: %s' % path
+        ofs=struct.calcsize(self.hdr_fmt)
+        zoom_len=struct.calcsize(self.zoom_fmt)
+        self.zooms={}
+        for i in range(nzooms):
+            z,nruns,runs_ofs,ntiles,codes_ofs=struct.unpack_from(self.zoom_fmt,self.mmap,ofs+i*zoom_len)
+            self.zooms[z]=(OpacityRuns(self.mmap,runs_ofs,nruns),codes_ofs)
+
+    def __del__(self):
+        self.mmap.close()
+        self.file.close()
+
+    # pickle the path only, an unpickled index maps the file again
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self,path):
+        self.__init__(path)
+
+    def code(self,codes_ofs,i):
+        return (ord(self.mmap[codes_ofs+(i>>2)])>>((i&3)*2)) & 3
+
+    def get(self,tile):
+        'opacity of a tile (z,x,y): 0, 1, -1 or None if not indexed'
+        z,x,y=tile
+        try:
+            runs,codes_ofs=self.zooms[z]
+        except KeyError:
+            return None
+        key=(y<<32)|x
+        r=bisect.bisect_right(runs,key)-1
+        if r < 0:
+            return None
+        start,length,first=runs.run(r)
+        if key-start >= length:
+            return None
+        return self.opacities[self.code(codes_ofs,first+key-start)]
+
+    def records(self):
+        'all the indexed tiles as (z,x,y,opacity)'
+        for z in sorted(self.zooms):
+            runs,codes_ofs=self.zooms[z]
+            for r in range(len(runs)):
+                start,length,first=runs.run(r)
+                for i in range(length):
+                    key=start+i
+                    yield z,key & 0xFFFFFFFF,key>>32,self.opacities[self.code(codes_ofs,first+i)]
+
+    @classmethod
+    def dump_chunk(cls,path,chunk):
+        chunk.sort()
+        with open(path,'wb') as f:
+            for i in range(0,len(chunk),4096):
+                f.write(''.join([struct.pack(cls.rec_fmt,*rec) for rec in chunk[i:i+4096]]))
+        return path
+
+    @classmethod
+    def load_chunk(cls,path):
+        rec_len=struct.calcsize(cls.rec_fmt)
+        with open(path,'rb') as f:
+            while True:
+                buf=f.read(rec_len*4096)
+                if not buf:
+                    break
+                for i in range(0,len(buf),rec_len):
+                    yield struct.unpack_from(cls.rec_fmt,buf,i)
+
+    @classmethod
+    def sorted_records(cls,path,records):
+        'records as (z,key,sequence,code) in the key order, the last one of a tile only; sorted in chunks on disk'
+        chunk_paths=[]
+        try:
+            chunk=[]
+            for seq,(z,x,y,opacity) in enumerate(records):
+                chunk.append((z,(y<<32)|x,seq,cls.codes[opacity]))
+                if len(chunk) >= cls.sort_chunk:
+                    chunk_paths.append(cls.dump_chunk('%s.sort.%d' % (path,len(chunk_paths)),chunk))
+                    chunk=[]
+            chunk.sort()
+            prev=None
+            for rec in heapq.merge(iter(chunk),*[cls.load_chunk(p) for p in chunk_paths]):
+                if prev is not None and rec[:2] != prev[:2]:
+                    yield prev
+                prev=rec
+            if prev is not None:
+                yield prev
+        finally:
+            for p in chunk_paths:
+                os.remove(p)
+
+    @classmethod
+    def write(cls,path,records):
+        'write an index from a sequence of (z,x,y,opacity), later records override earlier ones'
+        new=path+'.new'
+        zooms=[] # zoom, number of runs, runs offset, number of tiles, codes offset: within the sections
+        with open(new+'.runs','w+b') as runs_f, open(new+'.codes','w+b') as codes_f:
+            run=None
+            codes=bytearray()
+            for z,key,seq,code in cls.sorted_records(path,records):
+                if not zooms or zooms[-1][0] != z: # the codes of a zoom start at a byte
+                    if run:
+                        runs_f.write(struct.pack(OpacityRuns.run_fmt,*run))
+                        run=None
+                    codes_f.write(codes)
+                    codes=bytearray()
+                    zooms.append([z,0,runs_f.tell(),0,codes_f.tell()])
+                zoom=zooms[-1]
+                i=zoom[3]
+                if run and key == run[0]+run[1] and key>>32 == run[0]>>32: # next tile in the row
+                    run[1]+=1
+                else:
+                    if run:
+                        runs_f.write(struct.pack(OpacityRuns.run_fmt,*run))
+                    run=[key,1,i]
+                    zoom[1]+=1
+                if not i & 3:
+                    codes.append(0)
+                codes[-1]|=code<<((i&3)*2)
+                zoom[3]+=1
+                if i & 3 == 3 and len(codes) >= 65536:
+                    codes_f.write(codes)
+                    codes=bytearray()
+            if run:
+                runs_f.write(struct.pack(OpacityRuns.run_fmt,*run))
+            codes_f.write(codes)
+
+            # replace an existing index in one go, it may be mapped by a reader
+            runs_ofs=struct.calcsize(cls.hdr_fmt)+len(zooms)*struct.calcsize(cls.zoom_fmt)
+            codes_ofs=runs_ofs+runs_f.tell()
+            with open(new,'wb') as f:
+                f.write(struct.pack(cls.hdr_fmt,cls.magic,cls.version,len(zooms)))
+                for z,nruns,r_ofs,ntiles,c_ofs in zooms:
+                    f.write(struct.pack(cls.zoom_fmt,z,nruns,runs_ofs+r_ofs,ntiles,codes_ofs+c_ofs))
+                for section in (runs_f,codes_f):
+                    section.seek(0)
+                    shutil.copyfileobj(section,f)
+        os.remove(new+'.runs')
+        os.remove(new+'.codes')
+        shutil.move(new,path)
+
+class OpacitySink(object):
+    'streams tile opacities into part files, each process writes a separate part'
+
+    rec_fmt='<IIIb' # z,x,y,opacity
+
+    def __init__(self,path):
+        self.path=path
+        self.pid=None
+        self.file=None
+
+    def part_path(self):
+        return '%s.%d' % (self.path,os.getpid())
+
+    def write(self,tile,opacity):
+        if self.pid != os.getpid(): # a forked worker
+            self.file=open(self.part_path(),'ab')
+            self.pid=os.getpid()
+        self.file.write(struct.pack(self.rec_fmt,tile[0],tile[1],tile[2],opacity))
+
+    def flush(self):
+        if self.pid == os.getpid():
+            self.file.flush()
+
+    def parts(self):
+        return glob.glob(self.path+'.[0-9]*')
+
+    def recover(self):
+        'drop incomplete records left by an interrupted run'
+        rec_len=struct.calcsize(self.rec_fmt)
+        for part in self.parts():
+            size=os.path.getsize(part)
+            if size % rec_len:
+                with open(part,'r+b') as f:
+                    f.truncate(size-size % rec_len)
+
+    def records(self):
+        rec_len=struct.calcsize(self.rec_fmt)
+        for part in self.parts():
+            with open(part,'rb') as f:
+                while True:
+                    buf=f.read(rec_len*4096)
+                    if not buf:
+                        break
+                    for i in range(0,len(buf),rec_len):
+                        yield struct.unpack_from(self.rec_fmt,buf,i)
+
+    def close(self,keep=()):
+        'build an opacity index out of the parts written by all the processes and the records to keep'
+        if self.pid == os.getpid():
+            self.file.close()
+            self.pid=None
+        OpacityIndex.write(self.path,RecordReader(lambda: itertools.chain(keep,self.records())))
+        for part in self.parts():
+            os.remove(part)
+
+class RecordReader(object):
+    're-iterable wrapper for a generator function'
+    def __init__(self,gen_func):
+        self.gen_func=gen_func
+
+    def __iter__(self):
+        return self.gen_func()
+
+def write_opacities(path,opacities):
+    'write an opacity index from (tile_path,opacity) pairs'
+    OpacityIndex.write(path,[path2tile(tile_path)+(opacity,) 
+                                for tile_path,opacity in opacities if opacity is not None])
+
+class StageStats(object):
+    '''Call counts, bytes and wall/CPU times of processing stages, kept per process'''
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.pid=None
+
+    def stages(self):
+        if self.pid != os.getpid(): # a forked worker starts from scratch
+            self.data={}
+            self.pid=os.getpid()
+        return self.data
+
+    def add(self,stage,wall,cpu,nbytes=0,calls=1):
+        with self.lock:
+            st=self.stages().setdefault(stage,[0,0,0.0,0.0])
+            st[0]+=calls
+            st[1]+=nbytes
+            st[2]+=wall
+            st[3]+=cpu
+
+    def stage(self,name,nbytes=0):
+        'timing context for a stage: with stats.stage(name) as st: ...; st.nbytes=...'
+        return StageTimer(self,name,nbytes)
+
+    def take(self):
+        'get and reset the stats of this process'
+        with self.lock:
+            data=self.stages()
+            self.data={}
+        return data
+
+    def merge(self,data):
+        'add the stats taken from another process'
+        for stage,(calls,nbytes,wall,cpu) in data.items():
+            self.add(stage,wall,cpu,nbytes,calls)
+
+    def report(self):
+        with self.lock:
+            return dict([(stage,dict(calls=calls,bytes=nbytes,wall=wall,cpu=cpu))
+                            for stage,(calls,nbytes,wall,cpu) in self.stages().items()])
+
+class StageTimer(object):
+    def __init__(self,stats,stage,nbytes=0):
+        self.stats=stats
+        self.stage=stage
+        self.nbytes=nbytes
+
+    def __enter__(self):
+        self.wall=time.time()
+        self.cpu=thread_cpu_time()
+        return self
+
+    def __exit__(self,*exc_info):
+        self.stats.add(self.stage,time.time()-self.wall,thread_cpu_time()-self.cpu,self.nbytes)
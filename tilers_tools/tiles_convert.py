@@ -118,7 +118,7 @@ class TileSet(object):
                     os.remove(self.root)
             if region:
                 from gdal_tiler import Pyramid
-                self.pyramid=Pyramid.domain_class('gmaps')()
+                self.pyramid=Pyramid.profile_class('gmaps')()
                 self.pyramid.load_region(region)
                 self.pyramid.set_zoom_range(zoom)
 
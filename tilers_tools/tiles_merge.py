@@ -33,7 +33,6 @@ import shutil
 import logging
 import optparse
 from PIL import Image
-import pickle
 
 from tiler_functions import *
 
@@ -117,14 +116,13 @@ class MergeSet:
             os.chdir(cwd)
         ld(self.src_lst)
         
-        # load cached tile transparency data if any
-        self.src_transp=dict.fromkeys(self.src_lst,None)
+        # map cached tile transparency data if any
         self.src_cache_path=os.path.join(self.src, 'merge-cache')
         try:
-            self.src_transp.update(pickle.load(open(self.src_cache_path,'r')))
+            self.src_transp=OpacityIndex(self.src_cache_path)
         except:
             ld("cache load failed")
-        ld(repr(self.src_transp))
+            self.src_transp=None
         
         # define crop map for underlay function
         tsx,tsy=self.tile_sz
@@ -182,7 +180,7 @@ class MergeSet:
                     os.makedirs(dpath)
                 except os.error: pass 
             src_raster=None
-            transp=self.src_transp[tile]
+            transp=self.src_transp.get(path2tile(tile)) if self.src_transp else None
             if transp == None: # transparency value not cached yet
                 #pf('!',end='')
                 src_raster=Image.open(src_path).convert("RGBA")
@@ -209,9 +207,9 @@ class MergeSet:
         return (tile,transp) # send back transparency values for caching
 
     def upd_stat(self,transparency_data):
-        self.src_transp.update(dict(transparency_data))
+        self.src_transp=None # unmap the old cache
         try:
-            pickle.dump(self.src_transp,open(self.src_cache_path,'w'))
+            write_opacities(self.src_cache_path,transparency_data)
         except:
             ld("cache save failed")
         pf('')
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 2026-10-18 12:00:00
+
+###############################################################################
+# Copyright (c) 2010, Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import sys
+import os
+import os.path
+import logging
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+
+from PIL import Image
+
+from tiler_functions import *
+import gdal_tiler
+from gdal_tiler import Pyramid, MBTiles
+
+#############################
+
+class TileLRU(object):
+    '''In-memory cache of encoded tiles bounded by size, the least recently used tiles go first'''
+#############################
+
+    entry_overhead=100 # bytes per a cached tile, empty tiles are cached too
+
+    def __init__(self,max_bytes):
+        self.max_bytes=max_bytes
+        self.nbytes=0
+        self.tiles=OrderedDict() # the most recently used at the end
+        self.lock=threading.Lock()
+
+    def size(self,res):
+        data,opacity=res
+        return len(data or '')+self.entry_overhead
+
+    def get(self,tile):
+        with self.lock:
+            res=self.tiles.pop(tile,None)
+            if res is not None:
+                self.tiles[tile]=res
+            return res
+
+    def put(self,tile,res):
+        with self.lock:
+            old=self.tiles.pop(tile,None)
+            if old is not None:
+                self.nbytes-=self.size(old)
+            self.tiles[tile]=res
+            self.nbytes+=self.size(res)
+            while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+                evicted,old=self.tiles.popitem(last=False)
+                self.nbytes-=self.size(old)
+
+# TileLRU
+
+#############################
+
+class Render(object):
+    '''A tile being rendered, other requests for the same tile wait for its result'''
+#############################
+
+    def __init__(self):
+        self.done=threading.Event()
+        self.result=None
+        self.error=None
+
+#############################
+
+class TileService(object):
+    '''Renders tiles on the first request, keeps them in memory and in an MBTiles disk cache'''
+#############################
+
+    def __init__(self,pyramid,cache_bytes):
+        self.pyramid=pyramid
+        self.lru=TileLRU(cache_bytes)
+        self.rendering={}
+        self.lock=threading.Lock()
+        self.base_lock=threading.Lock() # a GDAL dataset is not to be shared by threads
+
+    def open(self):
+        'set the pyramid up as gdal_tiler would, the base zoom is warped on demand'
+        p=self.pyramid
+        if not p.init_map(gdal_tiler.options.zoom):
+            return False
+        p.make_base_raster()
+
+        Image.init()
+        p.tile_format=Image.EXTENSION[p.tile_ext]
+        p.mbtiles=MBTiles(os.path.join(p.dest,p.base+'.mbtiles'),
+                          p.zoom_tiles,gdal_tiler.options.commit_interval)
+        p.opacity_sink=p.mbtiles
+        p.dedup=None
+        p.map_tiles()
+        p.tile_palette=p.init_palette()
+        p.write_mbtiles_metadata()
+        return True
+
+    def close(self):
+        self.pyramid.mbtiles.close()
+
+    def get(self,tile):
+        'encoded tile and its opacity, rendered on the first request'
+        res=self.lru.get(tile)
+        if res is not None:
+            return res
+
+        with self.lock:
+            render=self.rendering.get(tile)
+            owner=render is None
+            if owner:
+                render=self.rendering[tile]=Render()
+        if not owner: # coalesce with the request rendering it already
+            render.done.wait()
+            if render.error is not None:
+                raise render.error
+            return render.result
+
+        try:
+            res=self.cached(tile) or self.render(tile)
+            self.lru.put(tile,res)
+            render.result=res
+        except Exception as exc:
+            render.error=exc
+            raise
+        finally:
+            with self.lock:
+                del self.rendering[tile]
+            render.done.set()
+        return res
+
+    def cached(self,tile):
+        'a tile from the disk cache'
+        mbtiles=self.pyramid.mbtiles
+        opacity=mbtiles.read_opacity(tile)
+        if opacity is None:
+            return None
+        return (mbtiles.read_tile(tile) if opacity else None),opacity
+
+    def render(self,tile):
+        'warp a base or an anchor tile, build an overview one out of its children otherwise'
+        p=self.pyramid
+        img,opacity=None,0
+        if tile[0] == p.base_zoom:
+            with self.base_lock:
+                img,opacity=p.base_img.tile(*p.tile_map[tile][1:])
+            if img and p.palette:
+                img.putpalette(p.palette)
+        elif tile[0] in p.anchors: # the children are not needed unless the warp comes out empty
+            with self.base_lock: # the anchors share the GDAL datasets too
+                img,opacity=p.anchor_tile(tile)
+        if tile[0] != p.base_zoom and opacity == 0:
+            dz,ch_mozaic=p.tile_children(tile)
+            ch_results=[]
+            for ch in p.all_tiles & frozenset(ch_mozaic):
+                data,ch_opacity=self.get(ch)
+                if ch_opacity:
+                    ch_results.append((p.decode_tile(data,ch_opacity),ch,ch_opacity))
+            if ch_results or tile[0] not in p.anchors:
+                img,opacity=p.merge_children(ch_results,dz,ch_mozaic)
+
+        data=None
+        if img is None or opacity == 0:
+            opacity=0
+        else:
+            data=p.encode_tile(img)
+            p.mbtiles.store_tile(tile,data)
+        p.mbtiles.write(p.mbtiles.tile_key(tile),opacity)
+        return data,opacity
+
+# TileService
+
+#############################
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves z/x/y tiles, the empty ones and the ones outside of the pyramid are not found'''
+#############################
+
+    def do_GET(self):
+        service=self.server.service
+        p=service.pyramid
+        path=urlparse.urlparse(self.path).path.strip('/')
+        try:
+            tile=path2tile(path)
+        except (ValueError,TypeError):
+            tile=None
+        if tile is None or not path.endswith(p.tile_ext) or tile not in p.all_tiles:
+            self.send_error(404)
+            return
+        try:
+            data,opacity=service.get(tile)
+        except Exception as exc:
+            logging.exception('tile %s' % (tile,))
+            self.send_error(500,str(exc))
+            return
+        if not opacity:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type','image/%s' % p.tile_format.lower())
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,format,*args):
+        ld(format % args)
+
+class TileServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads=True
+
+#############################
+
+def main(argv):
+
+#############################
+
+    parser=gdal_tiler.option_parser()
+    parser.set_usage("usage: %prog <options>... input_file...")
+    parser.description='On-demand tile server for GDAL-compatible raster maps'
+    parser.add_option("--port", type='int', default=8000,
+        help='HTTP port (default: 8000)')
+    parser.add_option("--bind", default='localhost', metavar="ADDRESS",
+        help='address to listen at (default: localhost)')
+    parser.add_option("--memory-cache", type='int', default=64, metavar="MB",
+        help='in-memory tile cache size (default: 64)')
+
+    options,args=parser.parse_args(argv[1:])
+    gdal_tiler.options=options
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose==2 else
+        (logging.ERROR if options.verbose==0 else logging.INFO))
+
+    if options.list_profiles:
+        Pyramid.profile_lst(tty=True)
+        sys.exit(0)
+    if not args:
+        parser.error('No input file(s) specified')
+    if len(args) > 1 and not options.mosaic:
+        parser.error('Several sources are served as a --mosaic only')
+    if options.update_region or options.plan_shards or options.shard is not None or options.reduce_shards:
+        parser.error('--update-region and the shard options are not for the tile server')
+
+    if options.release:
+        options.overview_resampling,options.base_resampling=('antialias','bilinear')
+    options.stream_base=True # warp base tiles on demand
+    options.resume=True # the disk cache is kept for the same sources and options
+
+    # the disk cache is at the gdal_tiler destination
+    cls=Pyramid.profile_class(options.profile)
+    ext= cls.defaul_ext if options.strip_dest_ext is None else ''
+    dest=dest_path(options.mosaic or args[0],options.dest_dir,ext)
+    pyramid=cls(args[0],dest,options)
+    if options.mosaic:
+        pyramid.mosaic=args
+
+    service=TileService(pyramid,options.memory_cache*1024*1024)
+    if not service.open():
+        sys.exit(1)
+    server=TileServer((options.bind,options.port),TileHandler)
+    server.service=service
+    pf('\nserving %s at http://%s:%d/' % (dest,options.bind,options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+# main()
+
+if __name__=='__main__':
+
+    main(sys.argv)